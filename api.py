@@ -0,0 +1,420 @@
+'''
+A local, read-only JSON API over the term DBs written by `generate_db.py`
+
+Usage: `pipenv run cli serve [--port 8000]`
+More Info: `pipenv run cli serve --help`
+
+Endpoints (lists are paginated with `limit` and `offset`, and times are epoch seconds):
+  /terms
+  /terms/<term>
+  /terms/<term>/totals
+  /terms/<term>/classes/<crn>
+  /terms/<term>/classes/<crn>/transitions
+  /terms/<term>/departments
+  /terms/<term>/departments/<dept>/totals
+  /terms/<term>/departments/<dept>/courses
+  /terms/<term>/departments/<dept>/courses/<course>/totals
+  /terms/<term>/departments/<dept>/courses/<course>/sections
+  /health (the status of `cli watch`, 503 when it is unhealthy)
+
+Time series take `since` and `until` (epoch seconds, or local dates like 2020-09-21T08:00),
+and `step` (in seconds, see `data_access.RESOLUTIONS`).
+
+Responses have an ETag and Last-Modified from the DB's data version, so clients can
+revalidate them, and are cached in memory until the data changes.
+'''
+
+import os
+import re
+import json
+import glob
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode, unquote
+
+import requests
+
+import data_access as da
+import watcher
+from generate_db import print_info, print_error
+from settings import API_URL
+
+# The number of responses kept in memory, and the page size of lists
+CACHE_SIZE = 256
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+TOTALS_COLUMNS = ['time', 'seats', 'wait_seats', 'open_classes', 'waitlist_classes', 'full_classes', 'total_classes']
+SECTION_TOTALS_COLUMNS = TOTALS_COLUMNS[:-1]
+HISTORY_COLUMNS = ['time', 'seats', 'wait_seats']
+TRANSITION_COLUMNS = ['time', 'from_status', 'to_status', 'seats_delta']
+SUMMARY_COLUMNS = ['CRN', 'section', 'status', 'seats', 'first_full_time', 'time_to_fill', 'reopen_count']
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+'''
+Data versions
+'''
+
+def term_names():
+    paths = glob.glob(f'{da.ROOT}db/temp_*.sqlite3')
+    return sorted(os.path.basename(path)[len('temp_'):-len('.sqlite3')] for path in paths)
+
+def get_meta(term):
+    return dict(da.query(term, 'SELECT key, value FROM meta;'))
+
+# The ETag and (epoch) modification time of the data of `term`
+def term_version(term):
+    meta = get_meta(term)
+    modified = meta.get('data_modified')
+
+    # DBs written before `data_modified` existed
+    if not modified:
+        paths = [da.db_path(term), f'{da.db_path(term)}-wal']
+        modified = max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+
+    return f'{term}.{meta.get("data_version", 0)}.{int(float(modified))}', int(float(modified))
+
+# The version of all the terms, for `/terms`
+def all_versions():
+    versions = [term_version(term) for term in term_names() if da.data_exists(term)]
+    tag = '+'.join(tag for tag, _ in versions)
+    return tag, max((modified for _, modified in versions), default=0)
+
+'''
+Parameters
+'''
+
+def int_param(params, name, default=None, minimum=None, maximum=None):
+    value = params.get(name, default)
+
+    try:
+        value = value if value is None else int(value)
+    except ValueError:
+        raise ApiError(400, f'{name} must be an integer') from None
+
+    if value is not None and minimum is not None and value < minimum:
+        raise ApiError(400, f'{name} must be at least {minimum}')
+
+    return min(value, maximum) if value is not None and maximum is not None else value
+
+# Epoch seconds, or a local date or datetime in ISO format
+def time_param(params, name):
+    value = params.get(name)
+
+    if value is None or value.lstrip('-').isdigit():
+        return int_param(params, name)
+
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise ApiError(400, f'{name} must be epoch seconds or an ISO date') from None
+
+    # Dates without an offset are in the display timezone, like the app
+    return int(date.timestamp()) if date.tzinfo else da.to_epoch(date)
+
+def window_param(params):
+    window = (time_param(params, 'since'), time_param(params, 'until'))
+    return window if window != (None, None) else None
+
+def step_param(params):
+    return int_param(params, 'step', minimum=1)
+
+'''
+Routes
+'''
+
+def records(columns, rows):
+    return [dict(zip(columns, row)) for row in rows]
+
+def get_term(term, params):
+    meta = get_meta(term)
+    first, last = da.get_time_range(term)
+    return {
+        'term': term,
+        'data_version': int(meta.get('data_version', 0)),
+        'first': first,
+        'last': last,
+        'interval': int(meta.get('interval') or 0) * 60,
+        'rollup_interval': int(meta.get('rollup_interval') or meta.get('interval') or 0) * 60,
+        'storage': meta.get('storage'),
+        'sampling': meta.get('sampling') or 'grid',
+        'resolutions': da.get_resolutions(term),
+    }
+
+def get_terms(params):
+    return [get_term(term, params) for term in term_names() if da.data_exists(term)]
+
+def get_totals(term, params):
+    rows = da.load_classes_by_time(term, window_param(params), step_param(params), load=da.fetch_rows)
+    return records(TOTALS_COLUMNS, rows)
+
+def get_class(term, params, crn):
+    rows = da.get_class_history(term, int(crn), window_param(params), step_param(params), load=da.fetch_rows)
+    return records(HISTORY_COLUMNS, rows)
+
+def get_transitions(term, params, crn):
+    return records(TRANSITION_COLUMNS, da.get_class_transitions(term, int(crn), load=da.fetch_rows))
+
+def get_departments(term, params):
+    return da.get_departments(term)
+
+def get_department_totals(term, params, dept):
+    rows = da.get_department_classes(term, dept, window_param(params), step_param(params), load=da.fetch_rows)
+    return records(SECTION_TOTALS_COLUMNS, rows)
+
+def get_courses(term, params, dept):
+    return da.get_courses(term, dept)
+
+def get_course_totals(term, params, dept, course):
+    rows = da.get_course_classes(term, dept, course, window_param(params), step_param(params), load=da.fetch_rows)
+    return records(SECTION_TOTALS_COLUMNS, rows)
+
+def get_sections(term, params, dept, course):
+    return records(SUMMARY_COLUMNS, da.get_course_summaries(term, dept, course, load=da.fetch_rows))
+
+# (path pattern, handler). Handlers get the term, the query params and the other path parts.
+ROUTES = [
+    (r'/terms', None),
+    (r'/terms/(?P<term>[^/]+)', get_term),
+    (r'/terms/(?P<term>[^/]+)/totals', get_totals),
+    (r'/terms/(?P<term>[^/]+)/classes/(\d+)', get_class),
+    (r'/terms/(?P<term>[^/]+)/classes/(\d+)/transitions', get_transitions),
+    (r'/terms/(?P<term>[^/]+)/departments', get_departments),
+    (r'/terms/(?P<term>[^/]+)/departments/([^/]+)/totals', get_department_totals),
+    (r'/terms/(?P<term>[^/]+)/departments/([^/]+)/courses', get_courses),
+    (r'/terms/(?P<term>[^/]+)/departments/([^/]+)/courses/([^/]+)/totals', get_course_totals),
+    (r'/terms/(?P<term>[^/]+)/departments/([^/]+)/courses/([^/]+)/sections', get_sections),
+]
+ROUTES = [(re.compile(pattern + '/?'), handler) for pattern, handler in ROUTES]
+
+def find_route(path):
+    for pattern, handler in ROUTES:
+        match = pattern.fullmatch(path)
+        if match:
+            return match, handler
+
+    raise ApiError(404, f'Unknown endpoint {path}')
+
+# Lists are returned a page at a time, with the URL of the next page
+def paginate(path, params, result):
+    if not isinstance(result, list):
+        return result
+
+    limit = int_param(params, 'limit', PAGE_SIZE, minimum=1, maximum=MAX_PAGE_SIZE)
+    offset = int_param(params, 'offset', 0, minimum=0)
+    end = offset + limit
+
+    return {
+        'data': result[offset:end],
+        'offset': offset,
+        'limit': limit,
+        'total': len(result),
+        'next': f'{path}?{urlencode({**params, "offset": end})}' if end < len(result) else None,
+    }
+
+# Returns the (ETag, epoch modification time) of the data behind `path`, and
+# a function building its JSON body
+def resolve(path, params):
+    match, handler = find_route(path)
+
+    if handler is None:
+        return all_versions(), lambda: paginate(path, params, get_terms(params))
+
+    term = unquote(match.group('term'))
+    parts = [unquote(part) for part in match.groups()[1:]]
+
+    # Only the existing DBs can be opened
+    if term not in term_names() or not da.data_exists(term):
+        raise ApiError(404, f'No data for term {term}')
+
+    return term_version(term), lambda: paginate(path, params, handler(term, params, *parts))
+
+'''
+Server
+'''
+
+# Response bodies, keyed by (path, params, ETag)
+cache = da.QueryCache(CACHE_SIZE)
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server_version = 'OpenCourseData/1.0'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        if url.path.rstrip('/') == '/health':
+            self.send_health()
+            return
+
+        try:
+            body, tag, modified = self.build(url.path, params)
+        except ApiError as e:
+            self.send_json(e.status, json.dumps({'error': str(e)}).encode())
+            return
+        except Exception as e: # pylint: disable=broad-except
+            print_error(f'Request for {self.path} failed: {e!r}')
+            self.send_json(500, json.dumps({'error': 'Internal server error'}).encode())
+            return
+
+        headers = {
+            'ETag': f'"{tag}"',
+            'Last-Modified': formatdate(modified, usegmt=True),
+            # Always revalidate, which is cheap with the ETag
+            'Cache-Control': 'no-cache',
+        }
+
+        if self.not_modified(tag, modified):
+            self.send_json(304, None, headers)
+        else:
+            self.send_json(200, body, headers)
+
+    # The body of `path`, from the cache when its data didn't change
+    def build(self, path, params):
+        # Retry if the data changes while reading it, so the ETag always matches the body
+        for _ in range(3):
+            (tag, modified), build = resolve(path, params)
+            key = (path, tuple(sorted(params.items())), tag)
+            body = cache.get(key)
+
+            if body is not None:
+                return body, tag, modified
+
+            if self.not_modified(tag, modified):
+                return None, tag, modified
+
+            body = json.dumps(build(), separators=(',', ':')).encode()
+
+            if resolve(path, params)[0][0] == tag:
+                cache.put(key, body)
+                return body, tag, modified
+
+        return body, tag, modified
+
+    # Never cached, so that monitors always see the current status
+    def send_health(self):
+        status = watcher.health(watcher.read_status(f'{da.ROOT}{watcher.STATUS_PATH}'))
+        headers = {'Cache-Control': 'no-store'}
+
+        if status is None:
+            self.send_json(404, json.dumps({'error': 'The watcher (cli watch) never ran'}).encode(), headers)
+        else:
+            self.send_json(200 if status['healthy'] else 503, json.dumps(status).encode(), headers)
+
+    def not_modified(self, tag, modified):
+        match = self.headers.get('If-None-Match')
+
+        if match:
+            return f'"{tag}"' in [value.strip() for value in match.split(',')] or match.strip() == '*'
+
+        since = self.headers.get('If-Modified-Since')
+
+        if since:
+            try:
+                return parsedate_to_datetime(since) >= datetime.fromtimestamp(modified, timezone.utc)
+            except (TypeError, ValueError):
+                return False
+
+        return False
+
+    def send_json(self, status, body, headers=None):
+        self.send_response(status)
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+
+        self.end_headers()
+
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+# Handles requests on a fixed pool of threads, so that each thread's read-only
+# connections (see `data_access.connect`) are reused by later requests
+class PooledHTTPServer(HTTPServer):
+    verbose = False
+
+    def __init__(self, address, handler, threads, verbose=False):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='api')
+        self.verbose = verbose
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception: # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+def serve(host, port, threads, cache_size=CACHE_SIZE, verbose=False):
+    global cache
+    cache = da.QueryCache(cache_size)
+
+    server = PooledHTTPServer((host, port), ApiHandler, threads, verbose)
+    print_info(f'Serving the data API at http://{host}:{port}/terms')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+'''
+Client
+'''
+
+# A client of the API, which reuses its connections and revalidates the responses it already has
+class ApiClient:
+    def __init__(self, base_url, timeout=10, cache_size=64):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.responses = da.QueryCache(cache_size)
+
+    def get(self, path):
+        url = self.base_url + path
+        cached = self.responses.get(url)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304 and cached:
+            return cached[1]
+
+        if not response.ok:
+            try:
+                message = response.json()['error']
+            except (ValueError, KeyError):
+                message = response.reason
+            raise requests.HTTPError(f'{response.status_code}: {message}', response=response)
+
+        data = response.json()
+
+        if response.headers.get('ETag'):
+            self.responses.put(url, (response.headers['ETag'], data))
+
+        return data
+
+# Shared by all sessions of the web app
+client = ApiClient(API_URL)
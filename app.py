@@ -4,9 +4,7 @@
 
 import os
 import time
-import json
-import sqlite3
-from datetime import datetime
+from datetime import timedelta
 
 import streamlit as st
 import pandas as pd
@@ -14,14 +12,18 @@ import numpy as np
 import altair as alt
 import requests
 
-from generate_db import GitHistoryConverter
-from settings import Config, TERM_CODES_TO_CONFIG
+from api import client as api_client
+from jobs import runner
+from watcher import health, read_status
+from settings import API_URL, Config, TERM_CODES_TO_CONFIG
+from data_access import data_exists, load_classes_by_time, get_available_crn, get_departments, get_courses, \
+    get_department_classes, get_course_classes, get_class_history, get_time_range, get_resolutions, get_class_transitions, \
+    get_course_summaries, to_dates, to_epoch, downsample
 
 #
 # Data and term configuration
 #
 
-ROOT = './'
 TERM_CODES = {
     'Foothill, Winter 2021' : '202131',
     'De Anza, Winter 2021'  : '202132',
@@ -49,103 +51,32 @@ os.environ['TZ'] = 'UTC'
 # Data generator
 #
 
-progress_bar = None
-
-def setup_progress_bar(name):
-    global progress_bar
-
-    st.sidebar.text(name)
-    progress_bar = st.sidebar.progress(0)
-
-def update_progress_bar(value):
-    progress_bar.progress(value)
-
+# Conversions run in background jobs (see `jobs.py`), so they don't block any session.
+# NOTE: the converter only stores epoch times, so it no longer needs the original TZ
 def generate_data(settings, interval, full_reset):
-    st.sidebar.markdown('### Generating Data')
-    del os.environ['TZ']
-    # os.environ['TZ'] = ORIGINAL_TIMEZONE
-    GitHistoryConverter(
-        settings,
-        Config(interval, full_reset),
-        update_progress=update_progress_bar,
-        setup_progress=setup_progress_bar
-    ).convert()
-    os.environ['TZ'] = 'UTC'
-    st.caching.clear_cache()
-    st.balloons()
-
-#
-# Database Utilities
-#
+    return runner.submit(settings, Config(interval, full_reset))
 
-@st.cache(allow_output_mutation=True)
-def connect_db(term):
-    # TODO: check thread safety
-    conn = sqlite3.connect(f'{ROOT}db/temp_{term}.sqlite3', check_same_thread=False)
-    c = conn.cursor()
-    return c
-
-@st.cache(hash_funcs={sqlite3.Cursor:id})
-def data_exists(c):
-    tableExists = c.execute(
-        'SELECT name FROM sqlite_master WHERE type="table" AND name="classes"'
-    ).fetchone()
-    if tableExists and tableExists[0]:
-        return True
-    return False
+# Show the progress of a job until it is done
+def follow_job(job):
+    st.sidebar.markdown('### Generating Data')
 
-#
-# Queries
-#
+    if st.sidebar.button('Cancel'):
+        job.cancel()
 
-@st.cache(allow_output_mutation=True, hash_funcs={sqlite3.Cursor:id})
-def get_all_classes(c):
-    return c.execute('''
-        SELECT
-            time,
-            SUM(seats),
-            SUM(wait_seats),
-            COUNT(case status when "Open" then 1 else null end) as open_classes,
-            COUNT(case status when "Waitlist" then 1 else null end) as waitlist_classes,
-            COUNT(case status when "Full" then 1 else null end) as full_classes
-        FROM classes
-        GROUP BY time;
-    ''').fetchall()
-
-@st.cache(allow_output_mutation=True, hash_funcs={sqlite3.Cursor:id})
-def get_total_classes(c):
-    return c.execute('''
-        SELECT
-            time,
-            COUNT(CRN)
-        FROM classes
-        GROUP BY time;
-    ''').fetchall()
-
-@st.cache(allow_output_mutation=True, hash_funcs={sqlite3.Cursor:id})
-def count_times(c):
-    return c.execute('SELECT COUNT(time) FROM classes;').fetchone()
-
-@st.cache(allow_output_mutation=True, hash_funcs={sqlite3.Cursor:id})
-def get_available_crn(c):
-    return c.execute('SELECT DISTINCT CRN FROM classes;').fetchall()
-
-# TODO: hash
-# NOTE: this does not currently work beause we do not store dept, course, and section
-def get_one_class(c, dept, course, section):
-    return c.execute('SELECT * FROM classes WHERE dept = ? and course = ? and section = ?', [dept, course, section]).fetchall()
-
-# TODO: hash
-def get_one_class_by_crn(c, crn):
-    return c.execute('SELECT * FROM classes WHERE CRN = ?', [crn]).fetchall()
+    term_text = st.sidebar.empty()
+    progress_bar = st.sidebar.progress(0)
 
-#
-# Utilities
-#
+    while not job.wait(0.5):
+        term_text.text(job.term or 'Starting...')
+        progress_bar.progress(job.progress)
 
-# Create a date from an SQLite datetime string
-def dt(date_string):
-    return datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
+    if job.error:
+        st.sidebar.error(f'Data converter failed: {job.error}')
+    elif job.cancelled:
+        st.sidebar.warning('Data converter was cancelled')
+    else:
+        # NOTE: cached queries are keyed by the data version, which the converter bumps
+        st.balloons()
 
 #
 # Streamlit App
@@ -178,7 +109,8 @@ if page == 'Home':
 
     interval = 60
     if show_advanced_options:
-        interval = st.sidebar.slider('Interval time (in minutes)', value=60, min_value=5, max_value=60, step=5)
+        # Totals are always stored every 5 min, this is the interval of the class history
+        interval = st.sidebar.slider('Class interval time (in minutes)', value=60, min_value=5, max_value=60, step=5)
 
     if st.sidebar.button('Update'):
         generate_data(term_config, interval, False)
@@ -186,24 +118,68 @@ if page == 'Home':
     if st.sidebar.button('Regenerate'):
         generate_data(term_config, interval, True)
 
+    # The status of `cli watch`, when it keeps this term up to date
+    watch_status = health(read_status())
+    term_lag = watch_status and watch_status['terms'].get(TERM_CODES[term])
+
+    if term_lag:
+        lag = f'{(term_lag["lag"] or 0) // 60} min behind the data repo'
+        if watch_status['healthy']:
+            st.sidebar.success(f'Live updates: {lag}')
+        else:
+            st.sidebar.warning(f'Live updates: {"; ".join(watch_status["problems"])}')
+
+    # A job started by any session, which is followed at the end of the page
+    job = runner.get(term_config)
+
     # Main Page Content
 
     # Load database
-    c = connect_db(TERM_CODES[term])
+    term_code = TERM_CODES[term]
 
-    # Generate data if necessary
-    if not data_exists(c):
-        generate_data(term_config, interval, True)
+    # Generate data if necessary (this also migrates DBs with an older schema)
+    if not data_exists(term_code):
+        follow_job(job or generate_data(term_config, interval, False))
+        job = None
+
+        if not data_exists(term_code):
+            'No data yet! Use the sidebar to generate it.'
+            st.stop()
+
+    # Only the selected dates (at the selected resolution) are queried, and charts are reduced to `points` points
+    st.sidebar.markdown('## VIEW')
+
+    window = None
+    first, last = get_time_range(term_code)
+
+    if first is not None:
+        first_date, last_date = to_dates([first, last]).date
+        dates = st.sidebar.date_input(
+            'Dates', value=(first_date, last_date), min_value=first_date, max_value=last_date
+        )
+
+        if len(dates) == 2:
+            window = (to_epoch(dates[0]), to_epoch(dates[1] + timedelta(days=1)))
+
+    points = 1000
+    if show_advanced_options:
+        points = st.sidebar.slider('Points per chart', value=1000, min_value=100, max_value=5000, step=100)
 
-    # Get all class data aggregated by time
-    class_data = get_all_classes(c)
-    times = [dt(x[0]) for x in class_data]
-    # total_times = countTimes(c)[0]
+    # Defaults to the finest resolution which fits in `points`, so the page's size doesn't grow with the term
+    resolutions = get_resolutions(term_code)
+    start, end = window or (first or 0, (last or 0) + 1)
+    steps = list(resolutions.values())
+    fitting = [i for i, step in enumerate(steps) if step and (end - start) / step <= points]
+    resolution = st.sidebar.selectbox('Resolution', list(resolutions.keys()),
+                                      index=fitting[0] if fitting else len(steps) - 1)
+    step = resolutions.get(resolution)
 
-    l = len(class_data)
-    start_date = l and class_data[0][0]
-    end_index = (l - 1) or 0
-    end_date = l and class_data[end_index][0]
+    # Get all class data aggregated by time, every chart below is a view of it
+    class_data = load_classes_by_time(term_code, window, step)
+    times = class_data.index
+
+    start_date = times[0]
+    end_date = times[-1]
 
     f'''
     ## {term}
@@ -212,8 +188,8 @@ if page == 'Home':
 
     | Term   | (selected term) |
     | ---   | --- |
-    | Start | {dt(start_date).strftime('%b %d, %Y %I:%M %p')} |
-    | End   | {dt(end_date).strftime('%b %d, %Y %I:%M %p')} |
+    | Start | {start_date.strftime('%b %d, %Y %I:%M %p')} |
+    | End   | {end_date.strftime('%b %d, %Y %I:%M %p')} |
 
     '''
 
@@ -222,85 +198,78 @@ if page == 'Home':
     ### Raw Data
     '''
 
-    df = pd.DataFrame(
-        [x[1:] for x in class_data],
-        index=times,
-        columns=['Seats', 'Wait Seats', 'Open Classes', 'Waitlist', 'Full']
-    )
-    df
+    # Sent a page of `points` rows at a time
+    raw_data = class_data[['Seats', 'Wait Seats', 'Open Classes', 'Waitlist', 'Full']]
+    pages = max(-(-len(raw_data) // points), 1)
+
+    if pages > 1:
+        raw_page = st.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1)
+        raw_data = raw_data.iloc[(raw_page - 1) * points:raw_page * points]
+
+    raw_data
 
     '''
     ### Open Seats By Time
     '''
 
-    df = pd.DataFrame(
-        [x[1:3] for x in class_data],
-        index=times,
-        columns=['Seats', 'Wait Seats']
-    )
-    st.line_chart(df)
-
-    df2 = pd.DataFrame(
-        [x[1:3] for x in class_data],
-        index=pd.DatetimeIndex(times),
-        columns=['Seats', 'Wait Seats']
-    # )
-    ).resample('D').mean()
-    df = pd.DataFrame(
-        [x[1:3] for x in class_data],
-        index=pd.DatetimeIndex(times),
-        columns=['Seats', 'Wait Seats']
-    # ).shift()
-    ).resample('D').mean().shift()
-    st.line_chart(df.subtract(df2))
+    seats = class_data[['Seats', 'Wait Seats']]
+    st.line_chart(downsample(seats, points))
+
+    # Change in the daily average, from each day to the previous one
+    daily = seats.resample('D').mean()
+    st.line_chart(daily.shift().subtract(daily))
 
     '''
     ### Class Status By Time
     '''
 
-    df = pd.DataFrame(
-        [x[3:6] for x in class_data],
-        index=times,
-        columns=['Open', 'Waitlist', 'Full']
-    )
-    st.area_chart(df)
+    status = class_data[['Open Classes', 'Waitlist', 'Full']].rename(columns={'Open Classes': 'Open'})
+    st.area_chart(downsample(status, points))
 
     '''
     ### Total Class Count By Time
     '''
 
-    total_classes = get_total_classes(c)
-    df = pd.DataFrame(
-        [x[1:] for x in total_classes],
-        index=[dt(x[0]) for x in total_classes],
-        columns=['Classes']
-    )
-    st.line_chart(df)
+    st.line_chart(downsample(class_data[['Classes']], points))
 
     '''
-    ### View Course History
+    ### Department And Course History
     '''
 
-    # dept = st.text_input('Department', 'CS')
-    # course = st.text_input('Course', '1A')
-    # section = st.text_input('Section', '1Z')
-    # crs = get_one_class(c, dept, course, section)
+    departments = get_departments(term_code)
+
+    if departments:
+        dept = st.selectbox('Department', departments)
+        dept_data = get_department_classes(term_code, dept, window, step)
+        st.line_chart(downsample(dept_data[['Seats', 'Wait Seats']], points))
+
+        course = st.selectbox('Course', get_courses(term_code, dept))
+        course_data = get_course_classes(term_code, dept, course, window, step)
+        st.line_chart(downsample(course_data, points))
+
+        # When each section filled up, and how many times it reopened
+        get_course_summaries(term_code, dept, course)
+
+    else:
+        'No sections stored yet! Regenerate the term to add them.'
+
+    '''
+    ### View Class History
+    '''
 
     crn = st.text_input('Enter a CRN', 10152)
-    crs = get_one_class_by_crn(c, crn)
+    crs = get_class_history(term_code, crn, window, step)
 
-    if crs and len(crs) > 0:
-        df = pd.DataFrame(
-            [x[3:5] for x in crs],
-            index=[dt(x[0]) for x in crs],
-            columns=['Seats', 'Wait Seats']
-        )
-        st.line_chart(df)
+    if len(crs) > 0:
+        st.line_chart(downsample(crs, points))
+
+        'Status changes:'
+        get_class_transitions(term_code, crn)
 
     else:
         'CRN not found! Available CRN:'
-        # ', '.join([str(x[0]) for x in get_available_crn(c)])
-        df = pd.DataFrame(get_available_crn(c))
+        # ', '.join([str(x[0]) for x in get_available_crn(term_code)])
+        df = pd.DataFrame(get_available_crn(term_code))
         df
 
     '''
@@ -311,30 +280,35 @@ if page == 'Home':
     Or, head over to [opencourse.dev](https://opencourse.dev).
     '''
 
+    if job:
+        follow_job(job)
+
 
-# Owl API (playground, etc.)
+# Data API (playground, etc.)
 if page == 'API':
-    '''
-    # Owl API [deprecated]
-    ### More at [opencourse.dev:3000](https://opencourse.dev:3000)
+    f'''
+    # Data API
+    ### Serving the generated data at [{API_URL}]({API_URL}/terms)
+
+    Start it with `pipenv run cli serve`, and see `api.py` for all the endpoints.
 
     ## Playground
     '''
 
-    PREFIX = 'https://opencourse.dev:3000'
-    endpoint = st.text_input('Enter an API url:', value='/fh/single?dept=CS&course=1A')
-
-    response = requests.get(PREFIX + endpoint)
-    response.raise_for_status()
+    endpoint = st.text_input('Enter an API url:', value='/terms/202121/totals?step=3600&limit=100')
 
     try:
-        json = response.json()
-        st.json(response.json())
-    except:
-        st.text(response.text)
+        data = api_client.get(endpoint)
+    except requests.RequestException as e:
+        st.error(f'API request failed: {e}')
+        st.stop()
+
+    st.json(data)
 
-    df = pd.DataFrame(sum(list(dict(json).values()), []))
-    df
+    # Pages of rows
+    if isinstance(data, dict) and isinstance(data.get('data'), list):
+        df = pd.DataFrame(data['data'])
+        df
 
 
 # Quickstart page (guides for buliding your own analysis)
@@ -0,0 +1,302 @@
+'''
+Benchmarks the data converter and the web app's queries on a synthetic git history
+
+The fixture is a local git repo with `data/{term}_database.json` snapshots in the same
+shape as `live-fhda-class-data`, so no network access or real data is needed.
+
+Usage: `pipenv run cli bench [OPTIONS]`
+More Info: `pipenv run cli bench --help`
+'''
+
+import os
+import sys
+import json
+import sqlite3
+import random
+import shutil
+import platform
+import tempfile
+import statistics
+from os.path import join, dirname, abspath
+from subprocess import PIPE, DEVNULL, CalledProcessError, Popen, run
+from time import perf_counter
+
+import data_access as da
+from settings import Fall2020
+
+ROOT = dirname(abspath(__file__))
+
+# The terms of the fixture, converted with `generate --term fall2020`
+FIXTURE_SETTINGS = Fall2020
+FIXTURE_TERM = 'fall2020'
+
+'''
+Synthetic fixture
+'''
+
+class FixtureConfig:
+    commits = 200
+    departments = 40
+    courses = 10
+    sections = 4
+    change_rate = 0.05
+    commit_minutes = 30
+    seed = 0
+    # Sep 13, 2020, when Fall 2020 registration data starts
+    start_time = 1600000000
+
+    def __init__(self, commits = 200, departments = 40, courses = 10, sections = 4, change_rate = 0.05,
+                 commit_minutes = 30, seed = 0):
+        self.commits = commits
+        self.departments = departments
+        self.courses = courses
+        self.sections = sections
+        self.change_rate = change_rate
+        self.commit_minutes = commit_minutes
+        self.seed = seed
+
+    def to_dict(self):
+        return {
+            'commits': self.commits,
+            'departments': self.departments,
+            'courses': self.courses,
+            'sections': self.sections,
+            'change_rate': self.change_rate,
+            'commit_minutes': self.commit_minutes,
+            'seed': self.seed,
+        }
+
+def make_class(rng, crn, dept, course, section):
+    seats = rng.randint(0, 40)
+    return {
+        'CRN': crn,
+        'raw_course': f'{dept} {course}{section}',
+        'dept': dept,
+        'course': course,
+        'section': section,
+        'title': f'{dept} Course {course}',
+        'units': '4.5',
+        'start': '09/21/2020',
+        'end': '12/11/2020',
+        'seats': seats,
+        'wait_seats': 10,
+        'wait_cap': 10,
+        'status': 'Open' if seats else 'Waitlist',
+        'times': [{
+            'type': 'LEC',
+            'days': rng.choice(['MW', 'TTh', 'MTWTh']),
+            'start_time': '09:30 AM',
+            'end_time': '11:20 AM',
+            'instructor': ['Staff'],
+            'location': 'ONLINE',
+            'room': '',
+            'campus': 'FH',
+        }],
+    }
+
+# The classes of one term, as {dept: {'1': {course: {section: [class]}}}}
+def make_term(rng, config, index):
+    db = {}
+    crn = 10000 + index * 50000
+
+    for d in range(config.departments):
+        dept = f'D{d:02d}'
+        table = db.setdefault(dept, {'1': {}})['1']
+
+        for c in range(config.courses):
+            course = f'{c + 1}{"ABC"[c % 3]}'
+
+            for s in range(config.sections):
+                section = f'{s + 1:02d}{"WZ"[s % 2]}'
+                table.setdefault(course, {})[section] = [make_class(rng, crn, dept, course, section)]
+                crn += 1
+
+    return db
+
+# Change the seats (and status) of about `change_rate` of the classes
+def change_term(rng, config, classes):
+    for cl in rng.sample(classes, max(round(len(classes) * config.change_rate), 1)):
+        if cl['seats'] and rng.random() < 0.8:
+            cl['seats'] -= rng.randint(1, min(cl['seats'], 3))
+        elif not cl['seats'] and cl['wait_seats']:
+            cl['wait_seats'] -= 1
+        else:
+            cl['seats'] += rng.randint(1, 3)
+
+        if cl['seats']:
+            cl['status'] = 'Open'
+        else:
+            cl['status'] = 'Waitlist' if cl['wait_seats'] else 'Full'
+
+# Build the fixture repo at `path` with `git fast-import`. Returns the total size of the snapshots.
+def write_fixture(path, config):
+    rng = random.Random(config.seed)
+    terms = list(FIXTURE_SETTINGS.term_codes.values())
+    dbs = {term: make_term(rng, config, i) for i, term in enumerate(terms)}
+    classes = {
+        term: [ccc[0] for dept in db.values() for courses in dept['1'].values() for ccc in courses.values()]
+        for term, db in dbs.items()
+    }
+
+    os.makedirs(path, exist_ok=True)
+    run(['git', 'init', '--quiet', path], check=True)
+    run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=path, check=True)
+
+    process = Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=PIPE)
+    size = 0
+
+    def data(blob):
+        process.stdin.write(b'data %d\n' % len(blob))
+        process.stdin.write(blob)
+        process.stdin.write(b'\n')
+
+    for i in range(config.commits):
+        time = config.start_time + i * config.commit_minutes * 60 + rng.randint(0, 60)
+        user = f'Bench <bench@localhost> {time} +0000'
+
+        process.stdin.write(f'commit refs/heads/master\nauthor {user}\ncommitter {user}\n'.encode())
+        data(b'Update data')
+
+        for term in terms:
+            if i:
+                change_term(rng, config, classes[term])
+
+            blob = json.dumps(dbs[term]).encode()
+            size += len(blob)
+            process.stdin.write(f'M 644 inline data/{term}_database.json\n'.encode())
+            data(blob)
+
+    process.stdin.close()
+    if process.wait():
+        raise RuntimeError('git fast-import failed')
+
+    run(['git', 'checkout', '--quiet', '--force', 'master'], cwd=path, check=True)
+    return size
+
+'''
+Benchmarks
+'''
+
+# Run `cli generate` on the fixture in its own process. Returns the seconds it took, and the
+# peak RSS (in MB) of that process and its workers, which isn't reported on Windows.
+# NOTE: only this process is measured, not the earlier ones (such as `git fast-import`)
+def run_generate(fixture, workdir, args):
+    env = dict(os.environ, LIVE_DATA_ROOT=join(fixture, 'data', ''))
+    cmd = [sys.executable, join(ROOT, 'cli.py'), 'generate', '--term', FIXTURE_TERM, *args]
+
+    start = perf_counter()
+    process = Popen(cmd, cwd=workdir, env=env, stdout=DEVNULL, stderr=DEVNULL)
+
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        rss = None
+    else:
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        # Kilobytes on Linux, bytes on macOS
+        rss = round(usage.ru_maxrss / (1e6 if sys.platform == 'darwin' else 1e3), 1)
+
+    seconds = perf_counter() - start
+
+    if process.returncode:
+        raise CalledProcessError(process.returncode, cmd)
+
+    return seconds, rss
+
+def count_rows(workdir):
+    rows = 0
+    intervals = 0
+
+    for term in FIXTURE_SETTINGS.term_codes.values():
+        conn = sqlite3.connect(join(workdir, 'db', f'temp_{term}.sqlite3'))
+        rows += conn.execute('SELECT COUNT(*) FROM classes').fetchone()[0]
+        intervals += conn.execute('SELECT COUNT(*) FROM classes_by_time').fetchone()[0]
+        conn.close()
+
+    return rows, intervals
+
+# Median and max latency (in ms) of each app query, without the query cache
+def time_queries(workdir, repeat):
+    da.ROOT = join(workdir, '')
+    da.cache = da.QueryCache(0)
+
+    term = next(iter(FIXTURE_SETTINGS.term_codes.values()))
+    dept = da.get_departments(term)[0]
+    course = da.get_courses(term, dept)[0]
+    crn = da.get_available_crn(term)[0][0]
+    _, last = da.get_time_range(term)
+    day = (last - 24 * 60 * 60, last)
+
+    queries = {
+        'load_classes_by_time': lambda: da.load_classes_by_time(term),
+        'load_classes_by_time (1 day)': lambda: da.load_classes_by_time(term, day),
+        'load_classes_by_time (hourly)': lambda: da.load_classes_by_time(term, step=60 * 60),
+        'get_time_range': lambda: da.get_time_range(term),
+        'get_departments': lambda: da.get_departments(term),
+        'get_department_classes': lambda: da.get_department_classes(term, dept),
+        'get_course_classes': lambda: da.get_course_classes(term, dept, course),
+        'get_class_history': lambda: da.get_class_history(term, crn),
+        'get_class_transitions': lambda: da.get_class_transitions(term, crn),
+        'get_course_summaries': lambda: da.get_course_summaries(term, dept, course),
+        'get_available_crn': lambda: da.get_available_crn(term),
+    }
+    results = {}
+
+    for name, fn in queries.items():
+        times = []
+
+        for _ in range(repeat):
+            start = perf_counter()
+            fn()
+            times.append((perf_counter() - start) * 1000)
+
+        results[name] = {'median_ms': round(statistics.median(times), 3), 'max_ms': round(max(times), 3)}
+
+    return results
+
+# Build the fixture, convert it with `generate_args` and time the queries. Returns the report.
+def run_benchmark(config, generate_args=(), repeat=20, keep=None):
+    tmp = keep or tempfile.mkdtemp(prefix='data-analysis-bench-')
+    fixture = join(tmp, 'live-fhda-class-data')
+    workdir = join(tmp, 'data-analysis')
+
+    try:
+        shutil.rmtree(fixture, ignore_errors=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(join(workdir, 'db'))
+
+        start = perf_counter()
+        size = write_fixture(fixture, config)
+        fixture_seconds = perf_counter() - start
+
+        seconds, rss = run_generate(fixture, workdir, generate_args)
+        rows, intervals = count_rows(workdir)
+
+        # An update with no new commits, the common case when the app refreshes
+        update_seconds, _ = run_generate(fixture, workdir, [*generate_args, '--skip-reset'])
+
+        return {
+            'fixture': {
+                **config.to_dict(),
+                'classes': config.departments * config.courses * config.sections,
+                'snapshot_mb': round(size / 1e6, 2),
+                'seconds': round(fixture_seconds, 3),
+            },
+            'generate': {
+                'args': list(generate_args),
+                'seconds': round(seconds, 3),
+                'commits_per_second': round(config.commits / seconds, 1),
+                'snapshot_mb_per_second': round(size / 1e6 / seconds, 2),
+                'intervals': intervals,
+                'rows': rows,
+                'rows_per_second': round(rows / seconds),
+                'peak_rss_mb': rss,
+                'update_seconds': round(update_seconds, 3),
+            },
+            'queries': time_queries(workdir, repeat),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        }
+    finally:
+        if not keep:
+            shutil.rmtree(tmp, ignore_errors=True)
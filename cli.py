@@ -1,9 +1,26 @@
 #!/usr/bin/env python
 
 import os
+import csv
+import json
+import time
+import signal
+import timeit
+import sqlite3
 import click
 
-from generate_db import setup_cmd, Config, GitHistoryConverter, Summer2020, Fall2020
+# Optional, needed to export Parquet and Arrow files
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from generate_db import setup_cmd, Config, GitHistoryConverter, Summer2020, Fall2020, \
+    GitObjectReader, DECODERS, READABLE_CLASSES_QUERY, STORAGE_MODES, SAMPLING_MODES, read_schema_version, \
+    decode_snapshot, print_info, print_error
+from settings import TERM_CODES_TO_CONFIG
 
 @click.group(context_settings=dict(max_content_width=120))
 def cli():
@@ -17,13 +34,282 @@ def start(ctx):
     'Start the data analysis web app (streamlit)'
     os.system('pipenv run streamlit run app.py')
 
+@cli.command('serve')
+@click.option('--host', default='127.0.0.1', help='The address to listen on')
+@click.option('--port', '-p', type=int, default=8000, help='The port to listen on')
+@click.option('--threads', type=click.IntRange(1), default=8, metavar='<threads>',
+              help='The number of requests handled at a time, each with its own DB connections')
+@click.option('--cache-size', type=click.IntRange(0), default=256, metavar='<responses>',
+              help='The number of responses cached in memory')
+@click.option('--verbose', '-v', is_flag=True, help='Log every request')
+def serve(host, port, threads, cache_size, verbose):
+    'Serve the generated DBs as a read-only JSON API'
+    import api
+    api.serve(host, port, threads, cache_size, verbose)
+
+@cli.command('watch')
+@click.option('--term', '-t', 'terms', type=click.Choice(TERM_CODES_TO_CONFIG.keys()), multiple=True,
+              metavar='<term>', help='Watch the terms of this term code (can be repeated, default: the active terms)')
+@click.option('--every', type=click.IntRange(5), default=60, metavar='<seconds>',
+              help='How often to fetch the data repo')
+@click.option('--remote', default='origin', help='The remote of the data repo to fetch')
+@click.option('--branch', default='master', help='The branch of the data repo to follow')
+@click.option('--interval-time', '-i', type=click.IntRange(5, 60), default=60,
+              metavar='<minutes>', help='The interval of each class\' history of new DBs')
+@click.option('--batch-size', type=click.IntRange(1), default=5000,
+              metavar='<rows>', help='The number of rows to write per transaction')
+@click.option('--storage', type=click.Choice(STORAGE_MODES), default='dense', help='The storage format of new DBs')
+@click.option('--sampling', type=click.Choice(SAMPLING_MODES), default='grid', help='The sampling of new DBs')
+def watch(terms, every, remote, branch, interval_time, batch_size, storage, sampling):
+    'Keep the DBs up to date with the data repo, converting new snapshots as they land'
+    from watcher import Watcher, active_settings, unique_settings
+
+    settings = unique_settings(TERM_CODES_TO_CONFIG[term] for term in terms) or active_settings()
+    config = Config(interval_time, False, batch_size=batch_size, storage=storage, sampling=sampling)
+    watcher = Watcher(settings, config, every, remote, branch)
+
+    # Stop gracefully (after writing the rows read so far) when interrupted or terminated
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: watcher.stop())
+
+    watcher.run()
+
 @cli.command('to_csv')
 @click.argument('src')
 @click.argument('dest', required=False)
 def to_csv(src, dest):
     'Convert an sqlite DB into a .csv file'
     dest = dest or src.replace('.sqlite3', '.csv').replace('.db', '.csv')
-    os.system(f'sqlite3 -header -csv {src} "select * from classes;" > {dest}')
+
+    conn = sqlite3.connect(src)
+    version = read_schema_version(conn)
+    conn.close()
+
+    # Schema v1 DBs already store readable times and statuses
+    query = READABLE_CLASSES_QUERY if version and version >= 2 else 'select * from classes'
+    query = ' '.join(query.split())
+    os.system(f'sqlite3 -header -csv {src} "{query};" > {dest}')
+
+# Columns of `export`: (SQL expression, Arrow type, table which must be joined)
+# CSV files store readable local times instead, like `to_csv`
+EXPORT_COLUMNS = {
+    'time': ('classes.time', 'timestamp', None),
+    'CRN': ('classes.CRN', 'int64', None),
+    'status': ('statuses.name', 'string', 'statuses'),
+    'seats': ('classes.seats', 'int64', None),
+    'wait_seats': ('classes.wait_seats', 'int64', None),
+    'wait_cap': ('classes.wait_cap', 'int64', None),
+    'dept': ('sections.dept', 'string', 'sections'),
+    'course': ('sections.course', 'string', 'sections'),
+    'section': ('sections.section', 'string', 'sections'),
+    'first_full_time': ('class_summary.first_full_time', 'timestamp', 'class_summary'),
+    'time_to_fill': ('class_summary.time_to_fill', 'int64', 'class_summary'),
+    'reopen_count': ('class_summary.reopen_count', 'int64', 'class_summary'),
+}
+EXPORT_JOINS = {
+    'statuses': 'JOIN statuses ON statuses.id = classes.status',
+    'sections': 'LEFT JOIN sections ON sections.CRN = classes.CRN',
+    'class_summary': 'LEFT JOIN class_summary ON class_summary.CRN = classes.CRN',
+}
+EXPORT_FORMATS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.csv': 'csv'}
+
+def export_query(columns, fmt, since, until, crns):
+    from data_access import to_epoch
+
+    exprs = [EXPORT_COLUMNS[name][0] for name in columns]
+    joins = {EXPORT_COLUMNS[name][2] for name in columns} - {None}
+    where = []
+    params = []
+
+    if fmt == 'csv':
+        for i, name in enumerate(columns):
+            if EXPORT_COLUMNS[name][1] == 'timestamp':
+                exprs[i] = f"datetime({exprs[i]}, 'unixepoch', 'localtime')"
+
+    if since:
+        where.append('classes.time >= ?')
+        params.append(to_epoch(since))
+
+    if until:
+        where.append('classes.time < ?')
+        params.append(to_epoch(until))
+
+    if crns:
+        where.append(f'classes.CRN IN ({", ".join("?" * len(crns))})')
+        params.extend(crns)
+
+    # No ORDER BY, so that rows stream in index order without a sort
+    query = f'SELECT {", ".join(exprs)} FROM classes'
+    query += ''.join(f' {EXPORT_JOINS[table]}' for table in sorted(joins))
+    query += f' WHERE {" AND ".join(where)}' if where else ''
+    return query, params
+
+def arrow_schema(columns):
+    types = {
+        'timestamp': pyarrow.timestamp('s', tz='UTC'),
+        'int64': pyarrow.int64(),
+        'string': pyarrow.string(),
+    }
+    return pyarrow.schema([(name, types[EXPORT_COLUMNS[name][1]]) for name in columns])
+
+# Writes chunks of rows to a Parquet, Arrow IPC or CSV file
+class ExportWriter:
+    def __init__(self, dest, fmt, columns):
+        self.fmt = fmt
+        self.file = open(dest, 'w' if fmt == 'csv' else 'wb', newline='' if fmt == 'csv' else None)
+
+        if fmt == 'csv':
+            self.writer = csv.writer(self.file, lineterminator='\n')
+            self.writer.writerow(columns)
+            return
+
+        self.schema = arrow_schema(columns)
+
+        if fmt == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.file, self.schema, compression='zstd')
+        else:
+            self.writer = pyarrow.ipc.new_file(self.file, self.schema)
+
+    def write(self, rows):
+        if self.fmt == 'csv':
+            self.writer.writerows(rows)
+            return
+
+        arrays = [
+            pyarrow.array(values, type=field.type)
+            for values, field in zip(zip(*rows), self.schema)
+        ]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+        if self.fmt == 'parquet':
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def close(self):
+        if self.fmt != 'csv':
+            self.writer.close()
+        self.file.close()
+
+@cli.command('export')
+@click.argument('src')
+@click.argument('dest', required=False)
+@click.option('--format', '-f', 'fmt', type=click.Choice(['parquet', 'arrow', 'csv']),
+              help='The file format (by default from the extension of DEST, or parquet)')
+@click.option('--columns', '-c', metavar='<names>',
+              help=f'Comma separated columns to export, from: {", ".join(EXPORT_COLUMNS)}')
+@click.option('--since', type=click.DateTime(), metavar='<date>',
+              help='Only export rows from this time (in DISPLAY_TIMEZONE)')
+@click.option('--until', type=click.DateTime(), metavar='<date>',
+              help='Only export rows before this time (in DISPLAY_TIMEZONE)')
+@click.option('--crn', type=int, multiple=True, metavar='<crn>', help='Only export these CRNs (can be repeated)')
+@click.option('--chunk-size', type=click.IntRange(1), default=100000, metavar='<rows>',
+              help='The number of rows held in memory at a time')
+def export(src, dest, fmt, columns, since, until, crn, chunk_size):
+    'Export the classes of an sqlite DB to a Parquet, Arrow or .csv file'
+    base = src.replace('.sqlite3', '').replace('.db', '')
+    fmt = fmt or EXPORT_FORMATS.get(os.path.splitext(dest or '')[1], 'parquet')
+    dest = dest or f'{base}.{fmt}'
+    columns = columns.split(',') if columns else list(EXPORT_COLUMNS)[:6]
+
+    unknown = [name for name in columns if name not in EXPORT_COLUMNS]
+    if unknown:
+        print_error(f'Unknown columns: {", ".join(unknown)}')
+        return
+
+    if fmt != 'csv' and not pyarrow:
+        print_error(f'Exporting {fmt} files needs pyarrow (pipenv install pyarrow)')
+        return
+
+    conn = sqlite3.connect(f'file:{src}?mode=ro', uri=True)
+    version = read_schema_version(conn)
+
+    if not version or version < 2:
+        print_error(f'{src} has an old schema, run `generate --skip-reset` on it first')
+        conn.close()
+        return
+
+    query, params = export_query(columns, fmt, since, until, crn)
+    cursor = conn.execute(query, params)
+    writer = ExportWriter(dest, fmt, columns)
+    count = 0
+    start = time.perf_counter()
+
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            writer.write(rows)
+            count += len(rows)
+    finally:
+        writer.close()
+        conn.close()
+
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(dest) / 1e6
+    print_info(f'Exported {count} rows to {dest} ({size:.2f} MB) in {seconds:.2f} s '
+               f'({count / max(seconds, 1e-9):.0f} rows/s)')
+
+@cli.command('bench')
+@click.option('--commits', type=click.IntRange(2), default=200, help='The number of commits in the fixture')
+@click.option('--departments', type=click.IntRange(1), default=40, help='The number of departments per term')
+@click.option('--courses', type=click.IntRange(1), default=10, help='The number of courses per department')
+@click.option('--sections', type=click.IntRange(1), default=4, help='The number of sections per course')
+@click.option('--change-rate', type=click.FloatRange(0, 1), default=0.05,
+              help='The fraction of classes which change in each commit')
+@click.option('--seed', type=int, default=0, help='The seed of the fixture data')
+@click.option('--repeat', '-n', type=click.IntRange(1), default=20, help='The number of runs per query')
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True), help='Write the JSON report to a file')
+@click.option('--keep', type=click.Path(file_okay=False), help='Keep the fixture and DBs in this directory')
+@click.argument('generate_args', nargs=-1, type=click.UNPROCESSED)
+def bench(commits, departments, courses, sections, change_rate, seed, repeat, output, keep, generate_args):
+    '''
+    Benchmark `generate` and the web app queries on a synthetic git history
+
+    Options after `--` are passed to `generate`, such as `cli bench -- --workers 4`
+    '''
+    from benchmark import FixtureConfig, run_benchmark
+
+    config = FixtureConfig(commits, departments, courses, sections, change_rate, seed=seed)
+    report = json.dumps(run_benchmark(config, generate_args, repeat, keep), indent=2)
+
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
+        print_info(f'Wrote the benchmark report to {output}')
+    else:
+        click.echo(report)
+
+@cli.command('bench_decoders')
+@click.option('--term', '-t', type=click.Choice(TERM_CODES_TO_CONFIG.keys()), default='202121',
+              metavar='<code>', help='The term code of the snapshot, such as "202121"')
+@click.option('--sha', default='HEAD', metavar='<sha>', help='The commit to read the snapshot from')
+@click.option('--repeat', '-n', type=click.IntRange(1), default=20, help='The number of runs per decoder')
+def bench_decoders(term, sha, repeat):
+    'Compare the installed snapshot decoders on a real snapshot'
+    with GitObjectReader() as reader:
+        blob = reader.read(f'{sha}:data/{term}_database.json')
+
+    if blob is None:
+        print_error(f'No snapshot for term {term} at {sha}')
+        return
+
+    size = len(blob) / 1e6
+    click.echo(f'Snapshot: {sha}:data/{term}_database.json ({size:.2f} MB)\n')
+    expected = None
+
+    for name in DECODERS:
+        rows = decode_snapshot(blob, name)
+        seconds = timeit.timeit(lambda: decode_snapshot(blob, name), number=repeat) / repeat
+
+        if expected is None:
+            expected = rows
+        elif rows != expected:
+            print_error(f'{name} returned different rows')
+
+        click.echo(f'{name.ljust(10)} {seconds * 1000:8.2f} ms  {size / seconds:8.1f} MB/s  {len(rows)} rows')
 
 if __name__ == '__main__':
     cli() # pylint: disable=no-value-for-parameter
@@ -0,0 +1,540 @@
+'''
+Read-only access to the SQLite DBs written by `generate_db.py`, shared by all sessions of the web app
+
+Every thread gets its own read-only connection per term, and query results are cached
+by the `data_version` of the DB (see `bump_data_version`), so they are never stale.
+'''
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from generate_db import SCHEMA_VERSION, STATUSES, DB_PRAGMAS, read_schema_version
+from settings import DISPLAY_TIMEZONE
+
+ROOT = './'
+
+# The number of query results kept in memory, shared by all sessions
+CACHE_SIZE = 256
+
+'''
+Connections
+'''
+
+connections = threading.local()
+
+def db_path(term):
+    return f'{ROOT}db/temp_{term}.sqlite3'
+
+# Returns this thread's connection to the DB of `term`, or None if it doesn't exist yet
+def connect(term):
+    conns = getattr(connections, 'conns', None)
+
+    if conns is None:
+        conns = connections.conns = {}
+
+    if term not in conns:
+        try:
+            # Quoted, so that a term can't add URI parameters (such as another mode)
+            conn = sqlite3.connect(f'file:{quote(db_path(term))}?mode=ro', uri=True, isolation_level=None)
+        except sqlite3.OperationalError:
+            return None
+
+        # The converter enables WAL, so readers never block it (or each other)
+        for pragma in DB_PRAGMAS:
+            if 'journal_mode' not in pragma:
+                conn.execute(pragma)
+
+        conns[term] = conn
+
+    return conns[term]
+
+def data_version(conn):
+    try:
+        row = conn.execute('SELECT value FROM meta WHERE key = "data_version"').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return int(row[0]) if row else 0
+
+'''
+Query cache
+'''
+
+# Bounded LRU cache of query results, keyed by (term, data version, query, params)
+class QueryCache:
+    maxsize = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            rows = self.entries.get(key)
+
+            if rows is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+            return rows
+
+    def put(self, key, rows):
+        if self.maxsize <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = rows
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+cache = QueryCache(CACHE_SIZE)
+
+def fetch_rows(cursor):
+    return tuple(cursor.fetchall()) if cursor else ()
+
+# Runs a query on the DB of `term` and loads its result with `load`, or returns the cached result.
+# Query functions returning DataFrames take a `load` too, such as `fetch_rows` for the raw rows.
+# Results are shared between sessions, so they must not be modified.
+def query(term, sql, params=(), load=fetch_rows):
+    conn = connect(term)
+
+    if conn is None:
+        return load(None)
+
+    # Read the version and the rows from the same snapshot of the DB
+    conn.execute('BEGIN')
+
+    try:
+        key = (term, data_version(conn), sql, tuple(params), load)
+        result = cache.get(key)
+
+        if result is None:
+            result = load(conn.execute(sql, params))
+            cache.put(key, result)
+    finally:
+        conn.execute('COMMIT')
+
+    return result
+
+'''
+DataFrames
+'''
+
+# Convert epoch times into (naive) dates in the colleges' timezone
+def to_dates(times):
+    utc = pd.to_datetime(np.asarray(times, dtype=np.int64), unit='s', utc=True)
+    return utc.tz_convert(DISPLAY_TIMEZONE).tz_localize(None)
+
+# Convert a (naive) date or datetime in the colleges' timezone into an epoch time
+def to_epoch(date):
+    return int(pd.Timestamp(date).tz_localize(DISPLAY_TIMEZONE).timestamp())
+
+CLASSES_BY_TIME_COLUMNS = ['Seats', 'Wait Seats', 'Open Classes', 'Waitlist', 'Full', 'Classes']
+
+def fetch_classes_by_time(cursor):
+    rows = cursor.fetchall() if cursor else []
+    df = pd.DataFrame.from_records(rows, columns=['time'] + CLASSES_BY_TIME_COLUMNS)
+    df = df.fillna(0).astype(np.int64)
+    df.index = to_dates(df.pop('time'))
+    return df
+
+CLASS_TOTALS_COLUMNS = ['Seats', 'Wait Seats', 'Open Classes', 'Waitlist', 'Full']
+
+def fetch_class_totals(cursor):
+    rows = cursor.fetchall() if cursor else []
+    df = pd.DataFrame.from_records(rows, columns=['time'] + CLASS_TOTALS_COLUMNS)
+    df = df.fillna(0).astype(np.int64)
+    df.index = to_dates(df.pop('time'))
+    return df
+
+CLASS_HISTORY_COLUMNS = ['Seats', 'Wait Seats']
+
+def fetch_class_history(cursor):
+    rows = cursor.fetchall() if cursor else []
+    df = pd.DataFrame.from_records(rows, columns=['time'] + CLASS_HISTORY_COLUMNS)
+    df.index = to_dates(df.pop('time'))
+    return df
+
+TRANSITION_COLUMNS = ['From', 'To', 'Seats Change']
+
+def fetch_transitions(cursor):
+    rows = cursor.fetchall() if cursor else []
+    df = pd.DataFrame.from_records(rows, columns=['time'] + TRANSITION_COLUMNS)
+    df['Seats Change'] = df['Seats Change'].astype('Int64')
+    df.index = to_dates(df.pop('time'))
+    return df
+
+CLASS_SUMMARY_COLUMNS = ['CRN', 'Section', 'Status', 'Seats', 'First Full', 'Time To Fill', 'Reopened']
+
+def fetch_class_summaries(cursor):
+    rows = cursor.fetchall() if cursor else []
+    df = pd.DataFrame.from_records(rows, columns=CLASS_SUMMARY_COLUMNS)
+    # Sections which never went full have no times
+    df['First Full'] = pd.to_datetime(df['First Full'], unit='s', utc=True).dt.tz_convert(DISPLAY_TIMEZONE) \
+        .dt.tz_localize(None)
+    df['Time To Fill'] = pd.to_timedelta(df['Time To Fill'], unit='s')
+    return df
+
+'''
+Queries
+'''
+
+def data_exists(term):
+    conn = connect(term)
+
+    if conn is None:
+        return False
+
+    tableExists = conn.execute(
+        'SELECT name FROM sqlite_master WHERE type IN ("table", "view") AND name="classes"'
+    ).fetchone()
+    if tableExists and tableExists[0]:
+        return read_schema_version(conn) == SCHEMA_VERSION
+    return False
+
+# NOTE: the converter keeps `classes_by_time` up to date, so these never aggregate the raw rows
+def get_all_classes(term):
+    return query(term, '''
+        SELECT
+            time,
+            seats,
+            wait_seats,
+            open_classes,
+            waitlist_classes,
+            full_classes
+        FROM classes_by_time
+        ORDER BY time;
+    ''')
+
+# The conditions (and their params) selecting the times in `window`, a (start, end) pair
+# of epoch times where the end is excluded and either can be None
+def time_filter(column, window):
+    start, end = window or (None, None)
+    conditions = []
+    params = []
+
+    if start is not None:
+        conditions.append(f'{column} >= ?')
+        params.append(int(start))
+
+    if end is not None:
+        conditions.append(f'{column} < ?')
+        params.append(int(end))
+
+    return conditions, params
+
+def where_clause(conditions):
+    return f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+# Resolutions the charts can be shown at, as steps in seconds
+RESOLUTIONS = {
+    '5 min': 5 * 60,
+    '10 min': 10 * 60,
+    '15 min': 15 * 60,
+    '30 min': 30 * 60,
+    '1 hour': 60 * 60,
+    '1 day': 24 * 60 * 60,
+}
+
+# The start of the interval grid, and the intervals (in seconds) of `classes_by_time` and `classes`
+def get_grid(term):
+    meta = dict(query(term, 'SELECT key, value FROM meta WHERE key IN ("origin", "interval", "rollup_interval");'))
+    interval = int(meta.get('interval') or 60) * 60
+    # DBs created before `rollup_interval` existed have a single grid
+    rollup = int(meta['rollup_interval']) * 60 if meta.get('rollup_interval') else interval
+    return int(meta.get('origin') or 0), rollup, interval
+
+# How the snapshots of the DB were sampled, see `SAMPLING_MODES`
+def get_sampling(term):
+    rows = query(term, 'SELECT value FROM meta WHERE key = "sampling";')
+    # DBs created before `sampling` existed are always on a grid
+    return rows[0][0] if rows and rows[0][0] else 'grid'
+
+# The resolutions which can be derived from `classes_by_time`. DBs sampling every commit
+# can be shown at their own times, or at any resolution.
+def get_resolutions(term):
+    if get_sampling(term) == 'commit':
+        return {'Every snapshot': None, **RESOLUTIONS}
+
+    _, rollup, _ = get_grid(term)
+    return {name: step for name, step in RESOLUTIONS.items() if step % rollup == 0}
+
+# The conditions (and their params) keeping every interval `step` seconds apart. `classes` rows
+# are only stored at the DB's interval, so coarser steps are only aligned with both.
+def step_filter(term, column, step):
+    origin, rollup, _ = get_grid(term)
+
+    if not step or step <= rollup:
+        return [], []
+
+    return [f'({column} - ?) % ? = 0'], [origin, int(step)]
+
+# For DBs sampling every commit, a `grid(time, snapshot)` CTE (and its params) with the times
+# every `step` seconds in `window`, and the latest snapshot at or before each of them (an as-of
+# join). Returns None for other DBs, which store their intervals on a grid (see `step_filter`).
+def grid_cte(term, window, step):
+    if not step or get_sampling(term) != 'commit':
+        return None, []
+
+    origin, _, _ = get_grid(term)
+    first, last = get_time_range(term)
+    start, end = window or (None, None)
+
+    if first is None:
+        return None, []
+
+    step = int(step)
+    start = max(first, int(start)) if start is not None else first
+    end = min(last + 1, int(end)) if end is not None else last + 1
+    # The first time of the grid from the start
+    start = origin - (origin - start) // step * step
+
+    return '''
+        WITH RECURSIVE ticks(time) AS (
+            SELECT ? WHERE ? < ?
+            UNION ALL
+            SELECT time + ? FROM ticks WHERE time + ? < ?
+        ),
+        grid(time, snapshot) AS (
+            SELECT time, (SELECT MAX(time) FROM classes_by_time WHERE classes_by_time.time <= ticks.time)
+            FROM ticks
+        )
+    ''', [start, start, end, step, step, end]
+
+# The first and last time of the data
+def get_time_range(term):
+    rows = query(term, 'SELECT MIN(time), MAX(time) FROM classes_by_time;')
+    return rows[0] if rows else (None, None)
+
+# `classes_by_time` as one typed DataFrame, indexed by date, every `step` seconds
+def load_classes_by_time(term, window=None, step=None, load=fetch_classes_by_time):
+    grid, grid_params = grid_cte(term, window, step)
+
+    if grid:
+        return query(term, f'''
+            {grid}
+            SELECT
+                grid.time,
+                seats,
+                wait_seats,
+                open_classes,
+                waitlist_classes,
+                full_classes,
+                total_classes
+            FROM grid
+            JOIN classes_by_time ON classes_by_time.time = grid.snapshot
+            ORDER BY grid.time;
+        ''', grid_params, load=load)
+
+    conditions, params = time_filter('time', window)
+    steps, step_params = step_filter(term, 'time', step)
+    conditions, params = conditions + steps, params + step_params
+    return query(term, f'''
+        SELECT
+            time,
+            seats,
+            wait_seats,
+            open_classes,
+            waitlist_classes,
+            full_classes,
+            total_classes
+        FROM classes_by_time
+        {where_clause(conditions)}
+        ORDER BY time;
+    ''', params, load=load)
+
+def get_total_classes(term):
+    return query(term, '''
+        SELECT
+            time,
+            total_classes
+        FROM classes_by_time
+        ORDER BY time;
+    ''')
+
+def count_times(term):
+    return query(term, 'SELECT COUNT(time) FROM classes;')[0]
+
+def get_available_crn(term):
+    return query(term, 'SELECT DISTINCT CRN FROM classes;')
+
+def get_departments(term):
+    return [x[0] for x in query(term, 'SELECT DISTINCT dept FROM sections ORDER BY dept;')]
+
+def get_courses(term, dept):
+    return [x[0] for x in query(term, 'SELECT DISTINCT course FROM sections WHERE dept = ? ORDER BY course;', [dept])]
+
+# Totals by time of the classes in `sections` matching `conditions`, as a DataFrame
+# NOTE: `sections` is looked up by (dept, course) first, then each CRN's history by the primary key
+def get_section_totals(term, conditions, params, window=None, step=None, load=fetch_class_totals):
+    grid, grid_params = grid_cte(term, window, step)
+
+    # Each snapshot is summed once, however many times of the grid it covers
+    if grid:
+        return query(term, f'''
+            {grid},
+            totals AS (
+                SELECT
+                    time,
+                    SUM(seats) AS seats,
+                    SUM(wait_seats) AS wait_seats,
+                    COUNT(case status when ? then 1 else null end) as open_classes,
+                    COUNT(case status when ? then 1 else null end) as waitlist_classes,
+                    COUNT(case status when ? then 1 else null end) as full_classes
+                FROM sections
+                JOIN classes ON classes.CRN = sections.CRN
+                {where_clause(conditions + ['classes.time IN (SELECT snapshot FROM grid)'])}
+                GROUP BY time
+            )
+            SELECT grid.time, seats, wait_seats, open_classes, waitlist_classes, full_classes
+            FROM grid
+            JOIN totals ON totals.time = grid.snapshot
+            ORDER BY grid.time;
+        ''', grid_params + [STATUSES['Open'], STATUSES['Waitlist'], STATUSES['Full']] + params, load=load)
+
+    times, time_params = time_filter('classes.time', window)
+    steps, step_params = step_filter(term, 'classes.time', step)
+    times, time_params = times + steps, time_params + step_params
+    return query(term, f'''
+        SELECT
+            time,
+            SUM(seats),
+            SUM(wait_seats),
+            COUNT(case status when ? then 1 else null end) as open_classes,
+            COUNT(case status when ? then 1 else null end) as waitlist_classes,
+            COUNT(case status when ? then 1 else null end) as full_classes
+        FROM sections
+        JOIN classes ON classes.CRN = sections.CRN
+        {where_clause(conditions + times)}
+        GROUP BY time
+        ORDER BY time;
+    ''', [STATUSES['Open'], STATUSES['Waitlist'], STATUSES['Full']] + params + time_params, load=load)
+
+def get_department_classes(term, dept, window=None, step=None, load=fetch_class_totals):
+    return get_section_totals(term, ['dept = ?'], [dept], window, step, load)
+
+def get_course_classes(term, dept, course, window=None, step=None, load=fetch_class_totals):
+    return get_section_totals(term, ['dept = ?', 'course = ?'], [dept, course], window, step, load)
+
+def get_one_class(term, dept, course, section):
+    return query(term, '''
+        SELECT classes.*
+        FROM sections
+        JOIN classes ON classes.CRN = sections.CRN
+        WHERE dept = ? AND course = ? AND section = ?
+        ORDER BY time;
+    ''', [dept, course, section])
+
+def get_one_class_by_crn(term, crn):
+    return query(term, 'SELECT * FROM classes WHERE CRN = ?', [crn])
+
+# The status changes of one class, as a DataFrame
+def get_class_transitions(term, crn, load=fetch_transitions):
+    return query(term, '''
+        SELECT time, from_statuses.name, to_statuses.name, seats_delta
+        FROM transitions
+        LEFT JOIN statuses AS from_statuses ON from_statuses.id = from_status
+        LEFT JOIN statuses AS to_statuses ON to_statuses.id = to_status
+        WHERE CRN = ?
+        ORDER BY time;
+    ''', [crn], load=load)
+
+# When each section of a course first went full, how long that took and how often it reopened
+def get_course_summaries(term, dept, course, load=fetch_class_summaries):
+    return query(term, '''
+        SELECT
+            sections.CRN,
+            section,
+            statuses.name,
+            seats,
+            first_full_time,
+            time_to_fill,
+            reopen_count
+        FROM sections
+        JOIN class_summary ON class_summary.CRN = sections.CRN
+        LEFT JOIN statuses ON statuses.id = class_summary.status
+        WHERE dept = ? AND course = ?
+        ORDER BY section;
+    ''', [dept, course], load=load)
+
+# The seats of one class by time, as a DataFrame
+def get_class_history(term, crn, window=None, step=None, load=fetch_class_history):
+    grid, grid_params = grid_cte(term, window, step)
+
+    if grid:
+        return query(term, f'''
+            {grid}
+            SELECT grid.time, seats, wait_seats
+            FROM grid
+            JOIN classes ON classes.CRN = ? AND classes.time = grid.snapshot
+            ORDER BY grid.time;
+        ''', grid_params + [crn], load=load)
+
+    conditions, params = time_filter('time', window)
+    steps, step_params = step_filter(term, 'time', step)
+    conditions, params = conditions + steps, params + step_params
+    return query(term, f'''
+        SELECT time, seats, wait_seats
+        FROM classes
+        {where_clause(['CRN = ?'] + conditions)}
+        ORDER BY time;
+    ''', [crn] + params, load=load)
+
+'''
+Downsampling
+'''
+
+# Largest-Triangle-Three-Buckets: the indices of `n` points of the line (x, y) which keep its
+# visual shape. The first and last points are kept, and from each bucket of the points between
+# them, the point forming the largest triangle with the previous pick and the next bucket's average.
+def lttb_indices(x, y, n):
+    size = len(x)
+
+    if n >= size or n < 3:
+        return np.arange(size)
+
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    indices = np.empty(n, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = size - 1
+    picked = 0
+
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        following = slice(end, edges[i + 2]) if i + 2 < n - 1 else slice(size - 1, size)
+        avg_x = x[following].mean()
+        avg_y = y[following].mean()
+
+        areas = np.abs(
+            (x[picked] - avg_x) * (y[start:end] - y[picked]) -
+            (x[picked] - x[start:end]) * (avg_y - y[picked])
+        )
+        picked = start + int(np.argmax(areas))
+        indices[i + 1] = picked
+
+    return indices
+
+# Reduce a DataFrame (indexed by date) to about `points` rows for charts, by picking
+# the rows which LTTB keeps for any of its columns
+def downsample(df, points):
+    if len(df) <= points or not len(df.columns):
+        return df
+
+    x = df.index.values.astype('datetime64[s]').astype(np.float64)
+    n = max(points // len(df.columns), 3)
+    indices = np.unique(np.concatenate([
+        lttb_indices(x, df[column].to_numpy(dtype=np.float64, na_value=np.nan), n)
+        for column in df.columns
+    ]))
+    return df.iloc[indices]
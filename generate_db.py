@@ -10,14 +10,41 @@ Direct Usage [not recommended]: `pipenv run generate_db.py [OPTIONS]`
 import sqlite3
 import json
 import math
+import re
 import os
+import signal
+import multiprocessing
+import queue
+import threading
+from itertools import groupby
+from contextlib import closing, contextmanager
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from os.path import join
-from subprocess import PIPE, run
+from subprocess import PIPE, DEVNULL, Popen, TimeoutExpired, run
 from datetime import datetime, timedelta
+from time import perf_counter
 
 import numpy as np
 import click
 
+# Optional, faster JSON decoders (see `DECODERS`)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Used to lock term DBs (see `DBLock`), which is skipped where it is missing (Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from settings import LIVE_DATA_ROOT, Summer2020, Fall2020, Config
 
 '''
@@ -40,10 +67,13 @@ def print_error(m):
 Date utilities
 '''
 
-# Find and return the index of the nearest date in a list of items
-def nearest_date(items, pivot):
-    time_diff = np.abs([date - pivot for date in items])
-    return time_diff.argmin(0)
+# Find the index of the nearest epoch (sorted ascending) for every pivot
+# Ties, and runs of identical epochs, resolve to the latest item
+def nearest_indices(epochs, pivots):
+    right = np.searchsorted(epochs, pivots).clip(0, len(epochs) - 1)
+    left = (right - 1).clip(0)
+    nearest = np.where(epochs[right] - pivots <= pivots - epochs[left], right, left)
+    return np.searchsorted(epochs, epochs[nearest], side='right') - 1
 
 # Round a date
 def floor_date(tm):
@@ -56,6 +86,66 @@ def floor_date(tm):
     #                       seconds=tm.second,
     #                       microseconds=tm.microsecond)
 
+'''
+Sampling plan
+'''
+
+# Maps a fixed time grid onto the nearest commit of a sorted changelog,
+# or every commit onto its own time (see SAMPLING_MODES)
+class SamplingPlan:
+    times = None
+    indices = None
+    shas = None
+    interval = None
+
+    def __init__(self, times, indices, shas, interval):
+        self.times = times
+        self.indices = indices
+        self.shas = shas
+        self.interval = interval
+
+    # Build the grid from `start` to `end` (epochs), every `interval` minutes
+    @classmethod
+    def build(cls, epochs, shas, start, end, interval):
+        step = interval * 60
+        count = max(math.ceil((end - start) / step), 0)
+        times = start + step * np.arange(count, dtype=np.int64)
+        return cls(times, nearest_indices(epochs, times), shas, interval)
+
+    # One point per commit from `start`, at the commit's own time. Commits
+    # made at the same time resolve to the latest one.
+    @classmethod
+    def snapshots(cls, epochs, shas, start):
+        times = np.unique(epochs[epochs >= start])
+        return cls(times, np.searchsorted(epochs, times, side='right') - 1, shas, None)
+
+    def __len__(self):
+        return len(self.times)
+
+    # Yields (index, epoch, sha) for every grid point
+    def __iter__(self):
+        for i, (time, index) in enumerate(zip(self.times.tolist(), self.indices.tolist())):
+            yield i, time, self.shas[index]
+
+    # Plan containing only the grid points after `epoch`
+    def resume(self, epoch):
+        i = np.searchsorted(self.times, epoch, side='right')
+        return SamplingPlan(self.times[i:], self.indices[i:], self.shas, self.interval)
+
+    # The commits to read, with runs of consecutive identical commits collapsed
+    def commits(self):
+        return [self.shas[index] for index, _ in groupby(self.indices.tolist())]
+
+    # The number of commits between the first and last read ones which the plan never samples
+    def skipped(self):
+        return int(self.indices[-1] - self.indices[0]) + 1 - len(self.commits()) if len(self) else 0
+
+    def start(self):
+        return datetime.fromtimestamp(self.times[0]) if len(self) else None
+
+    def end(self):
+        return datetime.fromtimestamp(self.times[-1]) if len(self) else None
+
 '''
 Git / Shell utilities
 '''
@@ -70,43 +160,1016 @@ def run_read(cmd):
 def git(cmd):
     os.system(f'cd {LIVE_DATA_ROOT} && git {cmd} --quiet')
 
-# Run and return output of `git show` (for viewing file at commit)
-# Ex. `git show {sha}:data/{term}_database.json`
-def gitShow(query):
-    return run_read(f'cd {LIVE_DATA_ROOT} && git show {query} --quiet')
+# Fetch `branch` from `remote` without touching the working tree, and return the fetched
+# commit, or `None` if the fetch failed
+def git_fetch(remote='origin', branch='master', timeout=120):
+    try:
+        result = run(['git', 'fetch', '--quiet', remote, branch], cwd=LIVE_DATA_ROOT,
+                     stdout=DEVNULL, stderr=PIPE, universal_newlines=True, timeout=timeout)
+    except TimeoutExpired:
+        print_error(f'git fetch timed out after {timeout}s')
+        return None
+
+    if result.returncode:
+        print_error(f'git fetch failed: {result.stderr.strip()}')
+        return None
+
+    return run_read(f'cd {LIVE_DATA_ROOT} && git rev-parse FETCH_HEAD') or None
+
+# Get the (author) timestamp of a commit, or `None` if it does not exist
+def git_commit_time(sha):
+    date = run_read(f'cd {LIVE_DATA_ROOT} && git show -s --format=%at {sha}')
+    return int(date) if date else None
 
 '''
-Git changelog generator
+Git object reader
+'''
+
+# Long-lived `git cat-file --batch` process for reading blobs at a commit
+# Ex. `reader.read(f'{sha}:data/{term}_database.json')`
+class GitObjectReader:
+    root = None
+    process = None
+
+    def __init__(self, root=LIVE_DATA_ROOT):
+        self.root = root
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        if self.process:
+            return
+
+        # Run in a new session so that Ctrl+C (SIGINT) only reaches python,
+        # and the reader survives for the remaining terms
+        self.process = Popen(['git', 'cat-file', '--batch'], cwd=self.root,
+                             stdin=PIPE, stdout=PIPE, stderr=DEVNULL,
+                             start_new_session=True)
+
+    def close(self):
+        if not self.process:
+            return
+
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+        self.process = None
+
+    # Read a single object, returns `None` if it does not exist
+    def read(self, query):
+        with closing(self.read_many([query])) as blobs:
+            return next(blobs)
+
+    # Read many objects, yielding blobs in the same order as the queries.
+    # Up to `depth` requests are kept in flight, which always fits in the pipe
+    # buffer, so a single pump thread can write requests and read responses.
+    # All pipe I/O happens on that thread, so Ctrl+C (which is raised on the
+    # main thread) can never interrupt a response halfway.
+    # Use with `contextlib.closing` so that exiting early drains the pipe.
+    def read_many(self, queries, depth=64):
+        results = queue.Queue(depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def pump():
+            pending = 0
+            try:
+                queries_left = iter(queries)
+                exhausted = False
+
+                while not stop.is_set():
+                    while not exhausted and pending < depth:
+                        query = next(queries_left, None)
+                        if query is None:
+                            exhausted = True
+                        else:
+                            self.request(query)
+                            pending += 1
+
+                    if not pending:
+                        break
+
+                    blob = self.response()
+                    pending -= 1
+                    put(blob)
+
+                # Drain responses to requests which were already sent
+                while pending:
+                    self.response()
+                    pending -= 1
+            except Exception as e: # pylint: disable=broad-except
+                put(e)
+
+            put(done)
+
+        thread = threading.Thread(target=pump, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def request(self, query):
+        self.process.stdin.write(query.encode() + b'\n')
+        self.process.stdin.flush()
+
+    def response(self):
+        header = self.process.stdout.readline()
+
+        if not header:
+            raise RuntimeError('git cat-file exited unexpectedly')
+
+        parts = header.split()
+        if parts[-1] in (b'missing', b'ambiguous'):
+            return None
+
+        size = int(parts[2])
+        blob = self.process.stdout.read(size)
+        self.process.stdout.read(1)
+        return blob
+
+'''
+Snapshot parsing
+'''
+
+# Walk course -> section of one department, keeping the
+# (CRN, status, seats, wait_seats, wait_cap, dept, course, section) of every section.
+# Only uses keys and indexing, so that a lazy (simdjson) document never
+# materialises the fields which are skipped.
+def walk_department(dept, data):
+    rows = []
+    table = data['1']
+
+    for course in table:
+        courses = table[course]
+
+        for section in courses:
+            cl = courses[section][0]
+
+            rows.append((
+                cl['CRN'],
+                cl['status'],
+                cl['seats'],
+                cl['wait_seats'],
+                cl['wait_cap'],
+                dept,
+                course,
+                section,
+            ))
+
+    return rows
+
+# Walk dept -> course -> section
+def walk_snapshot(db):
+    return [row for dept in db for row in walk_department(dept, db[dept])]
+
+# A simdjson parser reuses its buffers, so keep one per process
+simdjson_parser = None
+
+def parse_simdjson(blob):
+    global simdjson_parser
+
+    if not simdjson_parser:
+        simdjson_parser = simdjson.Parser()
+
+    return simdjson_parser.parse(blob)
+
+# Snapshot decoders as (name, module, parse), in order of preference for `auto`
+DECODER_TABLE = [
+    ('orjson', orjson, orjson and orjson.loads),
+    ('simdjson', simdjson, parse_simdjson),
+    ('json', json, json.loads),
+]
+DECODER_NAMES = ['auto'] + [name for name, _, _ in DECODER_TABLE]
+
+# How each installed decoder parses a snapshot
+DECODERS = {name: parse for name, module, parse in DECODER_TABLE if module}
+
+def decoder_name(name):
+    if name == 'auto' or name not in DECODERS:
+        return next(iter(DECODERS))
+    return name
+
+# Decode a snapshot into its rows
+def decode_snapshot(blob, decoder='auto'):
+    return walk_snapshot(DECODERS[decoder_name(decoder)](blob))
+
+WHITESPACE = re.compile(rb'\s*')
+SEPARATOR = re.compile(rb'\s*,\s*')
+END = re.compile(rb'\s*}\s*$')
+
+# A department of a snapshot: its JSON member (`"dept": {...}`) and its rows
+class Department:
+    def __init__(self, name, text=None, rows=None):
+        self.name = name
+        self.text = text
+        self.rows = rows
+        # Finds the start of this department in the next snapshot
+        self.key = re.compile(re.escape(json.dumps(name).encode()) + rb'\s*:')
+
+# Extracts the rows of consecutive snapshots of one term, only parsing and walking the departments
+# whose JSON changed since the previous snapshot. The rows of the other departments are reused.
+#
+# The departments of a snapshot are found by matching (or searching for) each department of the
+# previous snapshot in order, and every changed one is parsed on its own, which fails unless it's
+# exactly one department. When departments are added or removed, the whole snapshot is parsed.
+class SnapshotDiff:
+    blob = None
+    rows = ()
+    parsed = 0
+    reused = 0
+    # Set when a snapshot can't be split into its departments, which are then always walked
+    disabled = False
+
+    def __init__(self, decoder='auto'):
+        self.decoder = decoder
+        self.parse = DECODERS[decoder_name(decoder)]
+        self.departments = []
+
+    def extract(self, blob):
+        if blob is None:
+            return ()
+
+        if blob == self.blob:
+            self.reused += len(self.departments)
+            return self.rows
+
+        departments = None if self.disabled else self.split(blob, self.departments)
+
+        if departments is None and not self.disabled:
+            # Find the departments of the snapshot, and split it again
+            names = list(self.parse(blob))
+            departments = self.split(blob, [Department(name) for name in names])
+            self.disabled = departments is None and bool(names)
+
+        if departments is None:
+            self.rows = tuple(decode_snapshot(blob, self.decoder))
+            self.departments = []
+        else:
+            self.rows = tuple(row for dept in departments for row in dept.rows)
+            self.departments = departments
+
+        self.blob = blob
+        return self.rows
+
+    # Split `blob` into the given departments, in order. Returns None if it has other departments.
+    def split(self, blob, departments):
+        if not departments:
+            return None
+
+        cursor = WHITESPACE.match(blob, blob.find(b'{') + 1).end()
+        result = []
+        count = len(departments)
+
+        for i, dept in enumerate(departments):
+            if dept.text and blob.startswith(dept.text, cursor):
+                self.reused += 1
+                result.append(dept)
+            else:
+                # The department ends where the next one starts, or at the end of the snapshot
+                if i + 1 < count:
+                    match = departments[i + 1].key.search(blob, cursor)
+                    end = match.start() if match else -1
+                else:
+                    end = blob.rfind(b'}')
+
+                if end < cursor:
+                    return None
+
+                text = blob[cursor:end].rstrip()
+                if i + 1 < count:
+                    text = text[:-1].rstrip() if text.endswith(b',') else None
+
+                dept = self.parse_department(dept.name, text)
+                if dept is None:
+                    return None
+
+                self.parsed += 1
+                result.append(dept)
+
+            cursor += len(dept.text)
+            separator = (SEPARATOR if i + 1 < count else END).match(blob, cursor)
+
+            if not separator:
+                return None
+            cursor = separator.end()
+
+        return result
+
+    def parse_department(self, name, text):
+        if not text:
+            return None
+
+        try:
+            db = self.parse(b'{' + text + b'}')
+        except ValueError:
+            return None
+
+        if list(db) != [name]:
+            return None
+
+        return Department(name, text, walk_department(name, db[name]))
+
+# The snapshot diffs of a worker process, by term
+worker_diffs = {}
+
+# Extract (CRN, status, seats, wait_seats, wait_cap, dept, course, section)
+# tuples from a snapshot. With a `term`, they are extracted by diffing the previous
+# snapshot of the term which this process extracted (see `SnapshotDiff`).
+# NOTE: this runs inside worker processes when `--workers` is used, where each worker
+# diffs the snapshots it was given, which are usually a few commits apart.
+def extract_rows(blob, decoder='auto', term=None):
+    if blob is None:
+        return ()
+
+    if term is not None:
+        if term not in worker_diffs:
+            worker_diffs[term] = SnapshotDiff(decoder)
+        return worker_diffs[term].extract(blob)
+
+    return tuple(decode_snapshot(blob, decoder))
+
+# Leave Ctrl+C handling to the main process
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 '''
+Profiling
+'''
+
+# Timers and counters of the stages of a conversion. The time of a stage excludes the stages
+# nested in it, and with `trace` every stage is also kept as a Chrome trace event (see `write_trace`).
+# NOTE: only the main thread is profiled, so with `--workers` the decode stage is the time spent
+# waiting for the worker processes.
+class Profiler:
+    trace = False
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.start_time = perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.events = []
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        self.stack.append(0.0)
+
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+            nested = self.stack.pop()
+
+            if self.stack:
+                self.stack[-1] += duration
+
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += duration - nested
+            totals[1] += 1
+
+            if self.trace:
+                self.events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': round((start - self.start_time) * 1e6),
+                    'dur': round(duration * 1e6),
+                    'pid': os.getpid(),
+                    'tid': 0,
+                })
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def metrics(self):
+        return {
+            'seconds': perf_counter() - self.start_time,
+            'stages': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+    def summary(self):
+        metrics = self.metrics()
+        total = metrics['seconds']
+        lines = [f'{"Stage".ljust(20)} {"Seconds":>9} {"Calls":>8} {"%":>6}']
+
+        for name, stage in sorted(metrics['stages'].items(), key=lambda item: -item[1]['seconds']):
+            share = stage['seconds'] / total * 100 if total else 0
+            lines.append(f'{name.ljust(20)} {stage["seconds"]:9.3f} {stage["calls"]:8} {share:5.1f}%')
+
+        lines.append(f'{"Total".ljust(20)} {total:9.3f}')
+        lines.append('')
+
+        for name, value in metrics['counters'].items():
+            lines.append(f'{name.ljust(20)} {value:>9}')
+
+        return lines
+
+    # Write the stages as a Chrome trace (chrome://tracing, Perfetto or speedscope)
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': self.events,
+                'displayTimeUnit': 'ms',
+                'otherData': self.metrics()['counters'],
+            }, f)
+
+'''
+Database utilities
+'''
+
+# Tuned for bulk inserts; WAL also lets the app keep reading during writes
+DB_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+]
+
+# Version of the DB layout, stored in `meta` (see `migrate_tables`)
+#   1: text timestamps (local time) and text statuses
+#   2: integer epoch times, statuses in a `statuses` lookup table,
+#      and WITHOUT ROWID tables clustered on (CRN, time)
+#   3: `classes_by_time` rollup table
+#   4: `sections` table (dept, course and section of each CRN)
+#   5: `transitions` and `class_summary` tables (status changes of each CRN)
+SCHEMA_VERSION = 5
+
+# Well-known status ids, other statuses are added to `statuses` when they appear
+STATUSES = {'Open': 1, 'Waitlist': 2, 'Full': 3}
+
+# Storage formats for the `classes` data:
+#   dense:   one row per CRN per interval in the `classes` table
+#   changes: one row per CRN per change in `class_changes`, valid from
+#            `valid_from` up to (excluding) `valid_to`, plus the list of
+#            intervals in `times`. `classes` is a view rebuilding the dense rows.
+STORAGE_MODES = ['dense', 'changes']
+
+# How snapshots are sampled:
+#   grid:   the nearest commit to every point of a fixed grid (every `--interval-time` minutes)
+#           is stored at that point, and commits between points are skipped.
+#   commit: every commit is stored once, at its own time. Readers map the times of a
+#           grid onto the latest snapshot at or before them (see `data_access.grid_cte`).
+SAMPLING_MODES = ['grid', 'commit']
+
+# The interval (in minutes) of `classes_by_time`, so that the app can show any multiple of it
+# without a regeneration. `classes` rows are only stored at the (coarser) `--interval-time`.
+ROLLUP_INTERVAL = 5
+
+def rollup_interval(interval):
+    return ROLLUP_INTERVAL if interval % ROLLUP_INTERVAL == 0 else interval
+
+# Rows of `classes` with local text timestamps and status names (like schema v1)
+READABLE_CLASSES_QUERY = '''
+    SELECT
+        datetime(time, 'unixepoch', 'localtime') AS time,
+        CRN,
+        statuses.name AS status,
+        seats,
+        wait_seats,
+        wait_cap
+    FROM classes
+    JOIN statuses ON statuses.id = classes.status
+'''
+
+def read_schema_version(c):
+    try:
+        row = c.execute('SELECT value FROM meta WHERE key = "schema_version"').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return int(row[0]) if row else 1
+
+# Bumped with every write, so that readers know when cached results are stale.
+# `data_modified` is the (epoch) time of the write.
+def bump_data_version(c):
+    c.execute('''INSERT OR REPLACE INTO meta VALUES(
+                    "data_version",
+                    COALESCE((SELECT value FROM meta WHERE key = "data_version"), 0) + 1
+                 )''')
+    c.execute('''INSERT OR REPLACE INTO meta VALUES("data_modified", CAST(strftime('%s', 'now') AS INT))''')
+
+# Totals of all classes at each time, kept up to date by the writers
+# so that the dashboard never needs to aggregate the raw rows
+def create_rollup_tables(c: sqlite3.Cursor):
+    c.execute('DROP TABLE IF EXISTS classes_by_time')
+    c.execute('''CREATE TABLE classes_by_time (
+                    time INT PRIMARY KEY,
+                    seats INT,
+                    wait_seats INT,
+                    open_classes INT,
+                    waitlist_classes INT,
+                    full_classes INT,
+                    total_classes INT
+                ) WITHOUT ROWID''')
+
+# The department, course and section of each CRN, as of its latest snapshot
+def create_section_tables(c: sqlite3.Cursor):
+    c.execute('DROP TABLE IF EXISTS sections')
+    c.execute('''CREATE TABLE sections (
+                    CRN INT PRIMARY KEY,
+                    dept TEXT,
+                    course TEXT,
+                    section TEXT
+                ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX sections_course ON sections (dept, course)')
+
+# The status changes of each CRN (the first one is from NULL, when it's first seen), and a summary
+# of each CRN's history. `status` and `seats` are its latest values, which later changes are from.
+def create_transition_tables(c: sqlite3.Cursor):
+    c.execute('DROP TABLE IF EXISTS transitions')
+    c.execute('DROP TABLE IF EXISTS class_summary')
+    c.execute('''CREATE TABLE transitions (
+                    CRN INT,
+                    time INT,
+                    from_status INT,
+                    to_status INT,
+                    seats_delta INT,
+                    PRIMARY KEY (CRN, time)
+                ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX transitions_status ON transitions (to_status, time)')
+    c.execute('''CREATE TABLE class_summary (
+                    CRN INT PRIMARY KEY,
+                    status INT,
+                    seats INT,
+                    first_time INT,
+                    first_full_time INT,
+                    time_to_fill INT,
+                    reopen_count INT
+                ) WITHOUT ROWID''')
+
+# Open changes have no `valid_to`
+MAX_TIME = 2 ** 63 - 1
+
+# The dense rows of `class_changes`. CROSS JOIN keeps `class_changes` as the outer loop, so each
+# change is expanded with a range lookup on `times` (and CRN filters use the PK). Both ends of the
+# range must be plain comparisons, or SQLite scans `times` up to the end of the term for each change.
+def create_classes_view(c: sqlite3.Cursor):
+    c.execute('DROP VIEW IF EXISTS classes')
+    c.execute(f'''CREATE VIEW classes AS
+                SELECT
+                    times.time AS time,
+                    ch.CRN AS CRN,
+                    ch.status AS status,
+                    ch.seats AS seats,
+                    ch.wait_seats AS wait_seats,
+                    ch.wait_cap AS wait_cap
+                FROM class_changes AS ch
+                CROSS JOIN times
+                WHERE times.time >= ch.valid_from
+                    AND times.time < COALESCE(ch.valid_to, {MAX_TIME})''')
+
+def create_tables(c: sqlite3.Cursor, storage):
+    existing = c.execute('SELECT type FROM sqlite_master WHERE name="classes"').fetchone()
+    if existing:
+        c.execute(f'DROP {existing[0].upper()} classes')
+    c.execute('DROP TABLE IF EXISTS class_changes')
+    c.execute('DROP TABLE IF EXISTS times')
+    c.execute('DROP TABLE IF EXISTS statuses')
+
+    c.execute('''CREATE TABLE statuses (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE
+                )''')
+    c.executemany('INSERT INTO statuses VALUES(?, ?)', [(i, name) for name, i in STATUSES.items()])
+
+    if storage == 'changes':
+        c.execute('''CREATE TABLE times (
+                        time INT PRIMARY KEY
+                    ) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE class_changes (
+                        CRN INT,
+                        status INT,
+                        seats INT,
+                        wait_seats INT,
+                        wait_cap INT,
+                        valid_from INT,
+                        valid_to INT,
+                        PRIMARY KEY (CRN, valid_from)
+                    ) WITHOUT ROWID''')
+        create_classes_view(c)
+    else:
+        # Clustered by CRN for per-class history, the index covers per-time access
+        c.execute('''CREATE TABLE classes (
+                        time INT,
+                        CRN INT,
+                        status INT,
+                        seats INT,
+                        wait_seats INT,
+                        wait_cap INT,
+                        PRIMARY KEY (CRN, time)
+                    ) WITHOUT ROWID''')
+        c.execute('CREATE INDEX classes_time ON classes (time)')
+
+    create_rollup_tables(c)
+    create_section_tables(c)
+    create_transition_tables(c)
+
+# Convert the tables of a DB with an older schema version in place
+def migrate_tables(c: sqlite3.Cursor, storage, version):
+    if version < 2:
+        migrate_v1_tables(c, storage)
+
+    if version < 3:
+        create_rollup_tables(c)
+        c.execute('''INSERT INTO classes_by_time
+                     SELECT
+                        time,
+                        SUM(seats),
+                        SUM(wait_seats),
+                        COUNT(case status when ? then 1 else null end),
+                        COUNT(case status when ? then 1 else null end),
+                        COUNT(case status when ? then 1 else null end),
+                        COUNT(CRN)
+                     FROM classes
+                     GROUP BY time''', [STATUSES['Open'], STATUSES['Waitlist'], STATUSES['Full']])
+
+    # Older snapshots are not re-read, so only new data fills `sections`
+    if version < 4:
+        create_section_tables(c)
+        print_warning('Sections are only stored for new data, regenerate the term to include older classes')
+
+    # Older transitions are found from the stored rows, so they are only as precise as the DB's interval
+    if version < 5:
+        create_transition_tables(c)
+        tracker = TransitionTracker(c)
+
+        for time, crn, status, seats in c.execute('SELECT time, CRN, status, seats FROM classes ORDER BY time'):
+            tracker.add(time, crn, status, seats)
+
+        tracker.write(c)
+
+def migrate_v1_tables(c: sqlite3.Cursor, storage):
+    # Schema v1 times are local, which the 'utc' modifier converts from
+    def epoch(column):
+        return f"CAST(strftime('%s', {column}, 'utc') AS INT)"
+
+    if storage == 'changes':
+        c.execute('DROP VIEW classes')
+        c.execute('ALTER TABLE class_changes RENAME TO old_class_changes')
+        c.execute('ALTER TABLE times RENAME TO old_times')
+        old_table = 'old_class_changes'
+    else:
+        c.execute('DROP INDEX IF EXISTS time_crn')
+        c.execute('ALTER TABLE classes RENAME TO old_classes')
+        old_table = 'old_classes'
+
+    create_tables(c, storage)
+    c.execute(f'INSERT OR IGNORE INTO statuses (name) SELECT DISTINCT status FROM {old_table}')
+    status_id = f'(SELECT id FROM statuses WHERE name = {old_table}.status)'
+
+    if storage == 'changes':
+        c.execute(f'''INSERT OR IGNORE INTO class_changes
+                     SELECT CRN, {status_id}, seats, wait_seats, wait_cap, {epoch('valid_from')}, {epoch('valid_to')}
+                     FROM old_class_changes''')
+        c.execute(f'INSERT OR IGNORE INTO times SELECT {epoch("time")} FROM old_times')
+        c.execute('DROP TABLE old_times')
+    else:
+        c.execute(f'''INSERT OR IGNORE INTO classes
+                     SELECT {epoch('time')}, CRN, {status_id}, seats, wait_seats, wait_cap
+                     FROM old_classes''')
+
+    c.execute(f'DROP TABLE {old_table}')
+    c.execute(f'UPDATE meta SET value = {epoch("value")} WHERE key = "checkpoint"')
+
+# Finds the status transitions of each CRN, and keeps its `class_summary` row up to date
+class TransitionTracker:
+    def __init__(self, conn):
+        # CRN -> [status, seats, first_time, first_full_time, reopen_count]
+        self.classes = {
+            row[0]: list(row[1:])
+            for row in conn.execute('''SELECT CRN, status, seats, first_time, first_full_time, reopen_count
+                                       FROM class_summary''')
+        }
+        self.transitions = []
+        self.changed = set()
+
+    def add(self, time, crn, status, seats):
+        state = self.classes.get(crn)
+
+        if state is None:
+            self.classes[crn] = [status, seats, time, time if status == STATUSES['Full'] else None, 0]
+            self.transitions.append((crn, time, None, status, None))
+        elif state[0] != status:
+            self.transitions.append((crn, time, state[0], status, (seats or 0) - (state[1] or 0)))
+
+            if state[0] == STATUSES['Full']:
+                state[4] += 1
+            elif status == STATUSES['Full'] and state[3] is None:
+                state[3] = time
+
+            state[0] = status
+            state[1] = seats
+        elif state[1] != seats:
+            state[1] = seats
+        else:
+            return
+
+        self.changed.add(crn)
+
+    def write(self, conn):
+        conn.executemany('INSERT OR IGNORE INTO transitions VALUES(?, ?, ?, ?, ?)', self.transitions)
+        conn.executemany('INSERT OR REPLACE INTO class_summary VALUES(?, ?, ?, ?, ?, ?, ?)', [
+            (crn, status, seats, first, full, full and full - first, reopens)
+            for crn in self.changed
+            for status, seats, first, full, reopens in [self.classes[crn]]
+        ])
+        self.transitions = []
+        self.changed = set()
+
+class DBLockedError(Exception):
+    pass
+
+# Exclusive lock of a term DB, held while converting it, so that two converters
+# (such as the CLI and a job of the web app) never write the same DB at once
+class DBLock:
+    def __init__(self, path):
+        self.path = f'{path}.lock'
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+
+        if fcntl:
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.file.close()
+                raise DBLockedError(self.path)
+
+        return self
+
+    def __exit__(self, *args):
+        # Closing the file releases the lock
+        self.file.close()
+
+# Writes rows in fixed-size batches. Each batch is committed in a single
+# transaction together with a checkpoint (the last fully written interval),
+# so memory stays flat and an interrupted run can resume from the checkpoint.
+class BatchWriter:
+    conn = None
+    batch_size = 0
+    checkpoint = None
+    watermark = None
+    written = 0
+
+    # Rows are only stored for the intervals every `step` seconds from `origin`,
+    # `classes_by_time` has every interval
+    def __init__(self, conn, batch_size, profiler=None, origin=0, step=1):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.profiler = profiler or Profiler()
+        self.origin = origin
+        self.step = step
+        self.rows = []
+        self.rollups = []
+        self.statuses = dict(conn.execute('SELECT name, id FROM statuses'))
+        self.sections = {row[0]: row[1:] for row in conn.execute('SELECT * FROM sections')}
+        self.new_sections = {}
+        self.tracker = TransitionTracker(conn)
+        self.last_rows = None
+        self.totals = None
+
+    # Add all the rows of one interval (an epoch), read from commit `sha`
+    def add(self, time, rows, sha):
+        if self.stores(time):
+            ids = self.statuses
+            self.rows.extend((time, row[0], ids.get(row[1]) or self.add_status(row[1])) + row[2:5] for row in rows)
+
+        self.add_derived(time, rows)
+        self.checkpoint = time
+        self.watermark = sha
+
+        if len(self.rows) + len(self.rollups) >= self.batch_size:
+            self.flush()
+
+    def stores(self, time):
+        return (time - self.origin) % self.step == 0
+
+    def flush(self):
+        if self.checkpoint is None:
+            return
+
+        with self.profiler.stage('write'), self.conn:
+            self.conn.executemany('INSERT INTO classes VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING', self.rows)
+            self.write_derived()
+            self.write_checkpoint()
+
+        self.written += len(self.rows)
+        self.rows = []
+        self.checkpoint = None
+
+    # Add the `classes_by_time`, `sections` and `transitions` rows of an interval. Repeated
+    # commits pass the same (cached) rows, so each snapshot is only read once.
+    def add_derived(self, time, rows):
+        if self.last_rows is not rows:
+            self.last_rows = rows
+            self.totals = self.summarize(time, rows)
+
+        self.rollups.append((time,) + self.totals)
+
+    # Only the first row of each CRN is stored
+    def summarize(self, time, rows):
+        ids = self.statuses
+        track = self.tracker.add
+        seen = set()
+        counts = {}
+        seats = wait_seats = 0
+
+        for row in rows:
+            crn = row[0]
+            if crn in seen:
+                continue
+
+            seen.add(crn)
+            counts[row[1]] = counts.get(row[1], 0) + 1
+            seats += row[2] or 0
+            wait_seats += row[3] or 0
+            track(time, crn, ids.get(row[1]) or self.add_status(row[1]), row[2])
+
+            if self.sections.get(crn) != row[5:8]:
+                self.sections[crn] = self.new_sections[crn] = row[5:8]
+
+        return (seats, wait_seats, counts.get('Open', 0), counts.get('Waitlist', 0),
+                counts.get('Full', 0), len(seen))
+
+    def write_derived(self):
+        self.conn.executemany('INSERT OR IGNORE INTO classes_by_time VALUES(?, ?, ?, ?, ?, ?, ?)', self.rollups)
+        self.conn.executemany('INSERT OR REPLACE INTO sections VALUES(?, ?, ?, ?)',
+                              [(crn,) + section for crn, section in self.new_sections.items()])
+        self.tracker.write(self.conn)
+        self.rollups = []
+        self.new_sections = {}
+
+    # Statuses are inserted right away, and committed with the next batch
+    def add_status(self, name):
+        self.statuses[name] = self.conn.execute('INSERT INTO statuses (name) VALUES(?)', [name]).lastrowid
+        return self.statuses[name]
+
+    # The checkpoint, and the commit it was read from (the SHA watermark).
+    # Later intervals always map to this commit or newer ones.
+    def write_checkpoint(self):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['checkpoint', self.checkpoint])
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['last_sha', self.watermark])
+        bump_data_version(self.conn)
+
+# Writes only the rows whose values changed since the previous interval
+# (see STORAGE_MODES). Intervals which are still open are kept in memory
+# and re-read from the DB when resuming.
+class ChangeWriter(BatchWriter):
+    last_time = None
+    last_stored = None
+
+    def __init__(self, conn, batch_size, profiler=None, origin=0, step=1):
+        super().__init__(conn, batch_size, profiler, origin, step)
+        self.times = []
+        self.changes = {}
+        self.current = {}
+
+        for row in conn.execute('SELECT * FROM class_changes WHERE valid_to IS NULL'):
+            self.current[row[0]] = (row[1:5], row[5])
+
+        self.last_time = conn.execute('SELECT MAX(time) FROM times').fetchone()[0]
+
+    def add(self, time, rows, sha):
+        if self.last_time and time <= self.last_time:
+            self.profiler.count('intervals skipped')
+            return
+
+        if self.stores(time):
+            # Rows of the same commit as the last stored interval can't change anything
+            if rows is not self.last_stored:
+                self.add_changes(time, rows)
+                self.last_stored = rows
+
+            self.times.append(time)
+            self.last_time = time
+
+        self.add_derived(time, rows)
+        self.checkpoint = time
+        self.watermark = sha
+
+        if len(self.changes) + len(self.times) + len(self.rollups) >= self.batch_size:
+            self.flush()
+
+    def add_changes(self, time, rows):
+        ids = self.statuses
+        seen = set()
+
+        for row in rows:
+            crn = row[0]
+            if crn in seen:
+                continue
+
+            seen.add(crn)
+            values = (ids.get(row[1]) or self.add_status(row[1]),) + row[2:5]
+            cur = self.current.get(crn)
+
+            if cur is None or cur[0] != values:
+                if cur:
+                    self.close(crn, cur, time)
+                self.current[crn] = (values, time)
+                self.changes[(crn, time)] = (crn,) + values + (time, None)
+
+        for crn in [crn for crn in self.current if crn not in seen]:
+            self.close(crn, self.current.pop(crn), time)
+
+    def close(self, crn, cur, time):
+        values, valid_from = cur
+        self.changes[(crn, valid_from)] = (crn,) + values + (valid_from, time)
+
+    def flush(self):
+        if self.checkpoint is None:
+            return
+
+        with self.profiler.stage('write'), self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO class_changes VALUES(?, ?, ?, ?, ?, ?, ?)',
+                                  self.changes.values())
+            self.conn.executemany('INSERT OR IGNORE INTO times VALUES(?)', [(t,) for t in self.times])
+            self.write_derived()
+            self.write_checkpoint()
+
+        self.written += len(self.changes)
+        self.changes = {}
+        self.times = []
+        self.checkpoint = None
 
-# TODO: Convert this to a cross-platform script (probably rewrite in python)
-LOG_COMMAND = '''git log \
-    --date=raw \
-    --pretty=format:'{%n  "sha": "%H",%n  "author": "%aN <%aE>",%n  "date": "%ad",%n  "message": "%f"%n},' \
-    $@ | \
-    perl -pe 'BEGIN{print "["}; END{print "]\n"}' | \
-    perl -pe 's/},]/}]/'
 '''
+Git changelog generator
+'''
+
+# Stream (sha, timestamp, sanitized subject) of the commits in `revisions`,
+# newest first. Commits are NUL-delimited, so the log is never fully buffered.
+def git_log(revisions):
+    process = Popen(['git', 'log', '-z', '--format=%H %at %f', *revisions, '--'], cwd=LIVE_DATA_ROOT,
+                    stdout=PIPE, stderr=DEVNULL)
+    buffer = b''
+
+    try:
+        for chunk in iter(lambda: process.stdout.read(65536), b''):
+            *records, buffer = (buffer + chunk).split(b'\0')
+            for record in records:
+                yield record.decode().split(' ', 2)
+
+        if buffer:
+            yield buffer.decode().split(' ', 2)
+    finally:
+        process.stdout.close()
+        process.wait()
+
+# List the snapshots (`Update data` commits) of a term as parallel
+# (shas, epochs) arrays sorted by time, oldest first.
+# The term range is passed to git as `<end_sha> ^<start_sha>`, where unknown
+# SHAs are ignored. With `since`, only that commit and newer ones are listed.
+# Terms without an end are listed up to `head`.
+def read_changelog(settings, since=None, head='HEAD'):
+    end_sha = settings.end_sha if settings.end_sha and git_commit_time(settings.end_sha) else head
+    exclude = since or settings.start_sha
+    revisions = [end_sha]
+
+    if exclude and git_commit_time(exclude):
+        revisions.append(f'^{exclude}')
 
-def populate_changelog(settings):
-    rawlog = run_read(f'cd {LIVE_DATA_ROOT}/.. && ' + LOG_COMMAND)
-    snapshots = list(
-        filter(lambda c: c['message'] == 'Update-data', json.loads(rawlog)))
+    shas = []
+    epochs = []
+
+    for sha, epoch, message in git_log(revisions):
+        if message == 'Update-data':
+            shas.append(sha)
+            epochs.append(int(epoch))
 
-    # TODO: make the following loops more efficient
-    if settings.end_sha:
-        for i, s in enumerate(snapshots):
-            if s['sha'] == settings.end_sha:
-                snapshots = snapshots[i:]
-                break
+    if since:
+        shas.append(since)
+        epochs.append(git_commit_time(since))
 
-    if settings.start_sha:
-        for i, s in enumerate(snapshots):
-            if s['sha'] == settings.start_sha:
-                snapshots = snapshots[:i]
-                break
+    # Reverse the log, then sort by time, keeping the log order for ties
+    epochs = np.array(epochs[::-1], dtype=np.int64)
+    order = np.argsort(epochs, kind='stable')
+    shas = shas[::-1]
 
-    return snapshots
+    return [shas[i] for i in order.tolist()], epochs[order]
 
 '''
 Converts cool stuff into another format
@@ -119,71 +1182,181 @@ class GitHistoryConverter:
     # Hooks
     setup_progress = None
     update_progress = None
+    update_metrics = None
 
-    dates = []
-    shas = []
+    epochs = None
+    shas = None
+    reader = None
+    pool = None
+    profiler = None
 
     abort = False
+    cancelled = False
     cur_date = None
     cur_term = None
     term_index = None
 
-    def __init__(self, settings, config, setup_progress=None, update_progress=None):
+    # `update_metrics` is called with the metrics of the `profiler` after each term
+    def __init__(self, settings, config, setup_progress=None, update_progress=None, update_metrics=None):
         self.settings = settings
         self.config = config
         self.setup_progress = setup_progress
         self.update_progress = update_progress
+        self.update_metrics = update_metrics
+        self.profiler = Profiler(trace=bool(config.profile))
 
-    def convert(self):
+    # Converts the snapshots up to `head`, or pulls the data repo first and converts up to its HEAD
+    def convert(self, head=None):
         print_info('Starting up data converter...')
         print_info('Use Ctrl+C to gracefully exit early')
-        git('checkout master')
-        git('pull')
 
-        commits = populate_changelog(self.settings)
-        for commit in commits:
-            timestamp = int(commit['date'].replace(' +0000', ''))
-            self.dates.append(datetime.fromtimestamp(timestamp))
-            self.shas.append(commit['sha'])
+        if head is None:
+            head = 'HEAD'
+            with self.profiler.stage('git pull'):
+                git('checkout master')
+                git('pull')
+
+        # Incremental updates only need the commits since the oldest watermark
+        since = None if self.config.full_reset else self.oldest_watermark()
+
+        if since:
+            print_info(f'Reading new commits since {since[0:7]}')
+
+        with self.profiler.stage('read changelog'):
+            self.shas, self.epochs = read_changelog(self.settings, since, head)
+        if not self.shas:
+            print_error('No snapshots found in the changelog')
+            return
+
+        if self.config.decoder not in ('auto', *DECODERS):
+            print_warning(f'The {self.config.decoder} decoder is not installed, using {next(iter(DECODERS))}')
+
+        if self.config.workers > 1:
+            print_info(f'Parsing snapshots with {self.config.workers} worker processes')
+            # Spawn (rather than fork) so workers don't inherit the reader's pipes
+            self.pool = ProcessPoolExecutor(self.config.workers,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker)
+
+        try:
+            with GitObjectReader() as self.reader:
+                for i, (name, term) in enumerate(self.settings.term_codes.items()):
+                    if self.cancelled:
+                        break
+
+                    # Currently, abort acts like "skip ahead"
+                    self.abort = False
+                    self.cur_date = None
+                    self.cur_term = name.upper()
+                    self.term_index = i
+
+                    try:
+                        with DBLock(f'db/temp_{term}.sqlite3'), self.profiler.stage(f'term {term}'):
+                            self.parse_term(term)
+                    except DBLockedError:
+                        print_warning(f'Skipping term {term}, which is being converted by another process')
+
+                    if self.update_metrics:
+                        self.update_metrics(self.metrics())
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+                self.pool = None
+
+        counters = self.profiler.counters
+        print_info(f"{counters.get('commits read', 0)} commits read, {counters.get('intervals reused', 0)} intervals reused")
+
+        if self.config.profile:
+            self.write_profile(self.config.profile)
+
+        if self.cancelled:
+            print_info('Data converter was cancelled')
+        else:
+            print_info('Data converter has finished!')
+
+    # The profiler's timers and counters
+    def metrics(self):
+        return self.profiler.metrics()
+
+    def write_profile(self, path):
+        self.profiler.write_trace(path)
+
+        print_info('Profile:')
+        for line in self.profiler.summary():
+            click.echo(f'     {line}')
+        print_info(f'Wrote the trace to {path}')
+
+    # Stop converting, after writing the rows read so far (can be called from any thread)
+    def cancel(self):
+        self.cancelled = True
+        self.abort = True
+
+    # Read the SHA watermark and grid origin of a term DB (see `BatchWriter`)
+    def read_watermark(self, term):
+        path = f'db/temp_{term}.sqlite3'
+        if not os.path.exists(path):
+            return None
+
+        conn = sqlite3.connect(path)
+        try:
+            meta = dict(conn.execute('SELECT * FROM meta WHERE key IN ("last_sha", "origin")').fetchall())
+        except sqlite3.OperationalError:
+            meta = {}
+        finally:
+            conn.close()
+
+        return meta.get('origin') and meta.get('last_sha')
+
+    # The oldest watermark commit of all the terms, if every term has one
+    def oldest_watermark(self):
+        shas = set(self.read_watermark(term) for term in self.settings.term_codes.values())
+        if None in shas:
+            return None
 
-        for i, (name, term) in enumerate(self.settings.term_codes.items()):
-            # Currently, abort acts like "skip ahead"
-            self.abort = False
-            self.cur_date = None
-            self.cur_term = name.upper()
-            self.term_index = i
-            self.parse_term(term)
+        times = {sha: git_commit_time(sha) for sha in shas}
+        if None in times.values():
+            return None
 
-        print_info('Data converter has finished!')
+        return min(shas, key=times.get)
 
     def setup_db(self, term: str):
         conn = sqlite3.connect(f'db/temp_{term}.sqlite3')
         c = conn.cursor()
         alreadyExists = False
 
+        for pragma in DB_PRAGMAS:
+            c.execute(pragma)
+
         if not self.config.full_reset:
-            tableExists = c.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="classes"').fetchone()
+            tableExists = c.execute('SELECT name FROM sqlite_master WHERE type IN ("table", "view") AND name="classes"').fetchone()
 
             if tableExists and tableExists[0]:
                 alreadyExists = True
 
-        if not alreadyExists:
-            c.execute('DROP TABLE IF EXISTS classes')
-            c.execute('''CREATE TABLE classes (
-                            time TIMESTAMP,
-                            CRN INT,
-                            status TEXT,
-                            seats INT,
-                            wait_seats INT,
-                            wait_cap INT
-                        )''')
-            c.execute('CREATE UNIQUE INDEX time_crn ON classes (time, CRN)')
-
         if self.setup_meta_table(c):
             meta = self.read_meta(c)
         else:
             meta = None
 
+        if not alreadyExists:
+            create_tables(c, self.config.storage)
+            c.execute('DELETE FROM meta WHERE key IN ("checkpoint", "last_sha")')
+            bump_data_version(c)
+        else:
+            version = read_schema_version(c)
+            storage = (meta and meta.get('storage')) or 'dense'
+
+            # Older `classes` views scanned `times` up to the end of the term
+            if storage == 'changes' and version >= 2:
+                create_classes_view(c)
+                conn.commit()
+
+            if version < SCHEMA_VERSION:
+                print_info(f'Migrating DB to schema version {SCHEMA_VERSION}...')
+                migrate_tables(c, storage, version)
+                bump_data_version(c)
+                meta = self.read_meta(c)
+
         return (conn, c, alreadyExists, meta)
 
     def setup_meta_table(self, c: sqlite3.Cursor):
@@ -202,36 +1375,95 @@ class GitHistoryConverter:
 
         return alreadyExists
 
-    def write_meta(self, c: sqlite3.Cursor):
-        c.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['interval', self.config.interval_time])
+    def write_meta(self, c: sqlite3.Cursor, origin, interval, rollup, storage, sampling):
+        c.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['sampling', sampling])
+        c.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['interval', interval])
+        c.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['rollup_interval', rollup])
+        c.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['storage', storage])
+        c.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['origin', origin])
+        c.execute('INSERT OR REPLACE INTO meta VALUES(?, ?)', ['schema_version', SCHEMA_VERSION])
 
     def read_meta(self, c: sqlite3.Cursor):
         rows = c.execute('SELECT * FROM meta').fetchall()
         metadata = {row[0]:row[1] for row in rows}
         return metadata
 
+    # Start of the interval grid when creating a new DB
+    def origin(self):
+        return int(floor_date(datetime.fromtimestamp(self.epochs[0])).timestamp())
+
+    # Sampling plan covering all the snapshots, every `interval` minutes or every commit
+    def plan(self, origin, interval, sampling):
+        if sampling == 'commit':
+            return SamplingPlan.snapshots(self.epochs, self.shas, origin)
+
+        end = floor_date(datetime.fromtimestamp(self.epochs[-1])).timestamp()
+        return SamplingPlan.build(self.epochs, self.shas, origin, int(end), interval)
+
     def parse_term(self, term):
-        (conn, c, tableExists, meta) = self.setup_db(term)
+        with self.profiler.stage('setup db'):
+            (conn, c, tableExists, meta) = self.setup_db(term)
 
-        start_date = None
+        start = None
+        origin = None
+        interval = self.config.interval_time
+        rollup = rollup_interval(interval)
+        storage = self.config.storage
+        sampling = self.config.sampling
 
         if not self.config.full_reset and tableExists:
-            latest_item = c.execute('SELECT * FROM classes ORDER BY time DESC LIMIT 1').fetchone()
-
-            if latest_item:
-                start_date = datetime.fromisoformat(latest_item[0])
-                print_info(f'Skipping full reset')
-                click.echo(f'     {click.style("Start Date:", dim=True)} {start_date}')
+            # Resume from the last committed batch, or the latest row for older DBs
+            checkpoint = meta and meta.get('checkpoint')
 
-            if meta and (int(meta['interval']) != self.config.interval_time):
-                print_warning(f'Ignoring specified interval time ({self.config.interval_time} min)')
-                print_warning(f'Using the existing time instead ({meta["interval"]} min)')
-                self.config.interval_time = int(meta['interval'])
+            if not checkpoint:
+                checkpoint = c.execute('SELECT MAX(time) FROM classes').fetchone()[0]
 
-        cmds = []
+            if checkpoint:
+                start = int(checkpoint)
+                print_info(f'Skipping full reset')
+                click.echo(f'     {click.style("Start Date:", dim=True)} {datetime.fromtimestamp(start)}')
+
+            # DBs created before `sampling` existed are always on a grid
+            sampling = (meta and meta.get('sampling')) or 'grid'
+            if sampling != self.config.sampling:
+                print_warning(f'Ignoring specified sampling ({self.config.sampling})')
+                print_warning(f'Using the existing sampling instead ({sampling})')
+
+            # The grids of an existing DB can't change without a full reset. Coarser
+            # intervals are derived from `classes_by_time` when reading, so only warn
+            # when the requested interval can't be derived.
+            if meta and meta.get('interval') and sampling == 'grid':
+                interval = int(meta['interval'])
+                # DBs created before `rollup_interval` existed have a single grid
+                rollup = int(meta.get('rollup_interval') or interval)
+
+                if self.config.interval_time % rollup:
+                    print_warning(f'This DB stores {rollup} min totals and {interval} min class data, '
+                                  f'which can\'t serve {self.config.interval_time} min intervals')
+                    print_warning('Regenerate it (without --skip-reset) to change its intervals')
+                elif self.config.interval_time != interval:
+                    print_info(f'Using the existing interval time of {interval} min for class data')
+
+            # DBs created before `storage` existed are always dense
+            storage = (meta and meta.get('storage')) or 'dense'
+            if storage != self.config.storage:
+                print_warning(f'Ignoring specified storage format ({self.config.storage})')
+                print_warning(f'Using the existing format instead ({storage})')
+
+            # Keep extending the same interval grid
+            origin = meta and meta.get('origin') and int(meta['origin'])
+
+        origin = origin or self.origin()
+        self.write_meta(c, origin, interval, rollup, storage, sampling)
+        conn.commit()
+
+        # Every commit is stored when sampling commits
+        step = interval * 60 if sampling == 'grid' else 1
+        Writer = ChangeWriter if storage == 'changes' else BatchWriter
+        writer = Writer(conn, self.config.batch_size, self.profiler, origin, step)
 
         try:
-            self.loop(term, start_date, cmds)
+            self.loop(term, start, writer, self.plan(origin, rollup, sampling))
         except KeyboardInterrupt:
             print(f'\r{self.fterm()} Exited early at', self.cur_date, '             ', end='\r\n')
             self.abort = True
@@ -240,75 +1472,118 @@ class GitHistoryConverter:
             MSG_WROTE = 'Finished writing to DB   '
 
             print(f'{self.fterm()} ' + MSG_WRITING, end='\r')
-            # try:
-            c.executemany('INSERT INTO classes VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING', cmds)
-            # except sqlite3.IntegrityError:
-                # click.echo('uh oh', err=True)
-                # pass
-            self.write_meta(c)
-
-            conn.commit()
+            writer.flush()
             conn.close()
+            self.profiler.count('rows written', writer.written)
             print(f'{self.fterm()} {MSG_WROTE}')
 
-    def loop(self, term, start, cmds):
-        dlatest = floor_date(self.dates[0])
-        dfirst = start or floor_date(self.dates[-1])
+    def loop(self, term, start, writer, plan):
+        if start:
+            plan = plan.resume(start)
 
-        interval = self.config.interval_time
-        delta = (dlatest - dfirst).total_seconds() / 60
-        iter_count = math.ceil(delta / interval)
+        iter_count = len(plan)
 
         click.echo(f'{self.fterm()} Analyzing term {click.style(term, bold=True)}')
-        click.echo(f'     {click.style("Start:", dim=True)} {dfirst}')
-        click.echo(f'     {click.style("End:  ", dim=True)} {dlatest}')
-        click.echo(f'     {click.style("Data: ", dim=True)} {iter_count} chunks {click.style("of", dim=True)} {interval} min')
+        click.echo(f'     {click.style("Start:", dim=True)} {plan.start()}')
+        click.echo(f'     {click.style("End:  ", dim=True)} {plan.end()}')
+        if plan.interval:
+            click.echo(f'     {click.style("Data: ", dim=True)} {iter_count} chunks {click.style("of", dim=True)} {plan.interval} min')
+        else:
+            click.echo(f'     {click.style("Data: ", dim=True)} {iter_count} snapshots')
+
+        self.cur_date = plan.start()
+        self.profiler.count('commits skipped', plan.skipped())
 
-        self.cur_date = dfirst
+        prev_sha = None
+        rows = None
 
         if self.setup_progress:
             self.setup_progress(self.cur_term)
 
         with click.progressbar(
-            range(iter_count),
+            plan,
+            length=iter_count,
             fill_char='█',
             bar_template="     [%(bar)s]  %(info)s"
-        ) as bar:
-            for i in bar:
+        ) as bar, closing(self.snapshots(term, plan)) as snapshots:
+            for i, time, sha in bar:
                 if self.abort:
                     break
 
-                nearest_date_index = nearest_date(self.dates, self.cur_date)
-
                 # Disable progress bar and enable the following for advanced debugging
-                # print(f'{self.fterm()} Analyzing Commit: i =',
-                #     nearest_date_index, self.shas[nearest_date_index][0:6], end='\r')
+                # print(f'{self.fterm()} Analyzing Commit: i =', i, sha[0:6], end='\r')
+
+                self.cur_date = datetime.fromtimestamp(time)
+                self.profiler.count('intervals')
 
-                self.git_magic(term, cmds, self.shas[nearest_date_index], self.cur_date)
-                self.cur_date += timedelta(minutes=interval)
+                if sha != prev_sha:
+                    prev_sha = sha
+                    rows = next(snapshots)
+                else:
+                    # Same commit as the last grid point, reuse its rows
+                    self.profiler.count('intervals reused')
+
+                self.git_magic(writer, rows, time, sha)
 
                 if self.update_progress:
                     self.update_progress((i + 1) / iter_count)
 
-    def git_magic(self, term, cmds, sha, date):
-        db = json.loads(gitShow(f'{sha}:data/{term}_database.json'))
+    # Yields the rows of every commit in the plan, in order.
+    # Blobs are fetched by the reader's feeder thread and, with `--workers`,
+    # parsed by a process pool while earlier snapshots are being written.
+    def snapshots(self, term, plan):
+        commits = plan.commits()
+        queries = (f'{sha}:data/{term}_database.json' for sha in commits)
+        window = max(self.config.workers * 4, 1)
+        pending = deque()
+        # Workers keep their own diffs (see `extract_rows`)
+        diff = SnapshotDiff(self.config.decoder) if self.config.diff and not self.pool else None
+        diff_term = term if self.config.diff else None
+
+        def resolve(rows):
+            if not isinstance(rows, tuple):
+                with self.profiler.stage('decode'):
+                    rows = rows.result()
+            return rows
 
-        for dept in db:
-            table = db[dept]['1']
+        try:
+            with closing(self.reader.read_many(queries)) as blobs:
+                for sha in commits:
+                    with self.profiler.stage('read blobs'):
+                        blob = next(blobs)
+
+                    self.profiler.count('commits read')
+                    self.profiler.count('bytes read', len(blob or b''))
+
+                    if blob is None:
+                        print_warning(f'No data for term {term} at commit {sha}')
+
+                    if self.pool:
+                        rows = self.pool.submit(extract_rows, blob, self.config.decoder, diff_term)
+                    else:
+                        with self.profiler.stage('decode'):
+                            rows = diff.extract(blob) if diff else extract_rows(blob, self.config.decoder)
+
+                    pending.append(rows)
+
+                    if len(pending) >= window:
+                        yield resolve(pending.popleft())
+
+            while pending:
+                yield resolve(pending.popleft())
+        finally:
+            for rows in pending:
+                if not isinstance(rows, tuple):
+                    rows.cancel()
 
-            for courses in table.values():
-                for ccc in courses.values():
-                    cl = ccc[0]
+            if diff:
+                self.profiler.count('departments parsed', diff.parsed)
+                self.profiler.count('departments reused', diff.reused)
 
-                    data = [
-                        date,
-                        cl['CRN'],
-                        cl['status'],
-                        cl['seats'],
-                        cl['wait_seats'],
-                        cl['wait_cap'],
-                    ]
-                    cmds.append(data)
+    def git_magic(self, writer, rows, time, sha):
+        with self.profiler.stage('build rows'):
+            writer.add(time, rows, sha)
+        self.profiler.count('rows emitted', len(rows))
 
     def fterm(self):
         name = self.cur_term.ljust(4)
@@ -328,12 +1603,28 @@ def setup_cmd(ctx, name=None):
     @click.option('--term', '-t', type=choices, default=DEFAULT_TERM,
                   metavar='<quarter><year>', help='The term to generate data for, such as "Fall2020"')
     @click.option('--interval-time', '-i', type=click.IntRange(5, 60), default=60,
-                  metavar='<minutes>', help='The interval to generate time-series data')
+                  metavar='<minutes>', help='The interval of each class\' history (totals are stored every 5 min)')
     @click.option('--skip-reset', is_flag=True, default=False,
                   help='Only add new data to existing DBs')
-    def convert(term: str, interval_time: int, skip_reset: bool):
+    @click.option('--workers', '-w', type=click.IntRange(1), default=1,
+                  metavar='<count>', help='The number of processes used to parse snapshots')
+    @click.option('--batch-size', type=click.IntRange(1), default=50000,
+                  metavar='<rows>', help='The number of rows to write per transaction')
+    @click.option('--storage', type=click.Choice(STORAGE_MODES), default='dense',
+                  help='Store every row, or only rows which changed since the last interval')
+    @click.option('--sampling', type=click.Choice(SAMPLING_MODES), default='grid',
+                  help='Store the nearest snapshot every interval, or every snapshot at its own time')
+    @click.option('--decoder', type=click.Choice(DECODER_NAMES), default='auto',
+                  help='The JSON decoder used to parse snapshots (orjson and simdjson are optional)')
+    @click.option('--diff/--no-diff', default=True,
+                  help='Only parse the departments which changed since the previous snapshot')
+    @click.option('--profile', type=click.Path(dir_okay=False, writable=True), default=None,
+                  metavar='<trace.json>', help='Print the time spent in each stage, and write a Chrome trace of them')
+    def convert(term: str, interval_time: int, skip_reset: bool, workers: int, batch_size: int,
+                storage: str, sampling: str, decoder: str, diff: bool, profile: str):
         """Convert Git history repos into Sqlite3 database."""
-        config = Config(interval_time, not skip_reset)
+        config = Config(interval_time, not skip_reset, workers, batch_size, storage, decoder, profile, diff,
+                        sampling)
         converter = GitHistoryConverter(TERM_NAMES_TO_CONFIG[term.lower()], config)
         converter.convert()
 
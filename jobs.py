@@ -0,0 +1,118 @@
+'''
+Runs data conversions in background threads, so that the web app never blocks on them
+
+Jobs are shared by all sessions of the web app: requesting a conversion of terms which are
+already being converted returns the running job, and jobs run one at a time.
+'''
+
+import threading
+
+from generate_db import GitHistoryConverter, print_error
+
+# A conversion of the terms of `settings`, running in its own thread
+class GenerationJob:
+    settings = None
+    converter = None
+
+    # Progress of the term being converted (see the converter's hooks)
+    term = None
+    progress = 0.0
+    # The converter's stage timers and counters, after each term
+    metrics = None
+
+    cancelled = False
+    error = None
+
+    def __init__(self, settings, config, run_lock):
+        self.settings = settings
+        self.run_lock = run_lock
+        self.listeners = []
+        self.done = threading.Event()
+        # Orders `cancel` and the end of `run`
+        self.lock = threading.Lock()
+        self.converter = GitHistoryConverter(
+            settings,
+            config,
+            setup_progress=self.setup_progress,
+            update_progress=self.update_progress,
+            update_metrics=self.update_metrics
+        )
+        name = '-'.join(settings.term_codes.values())
+        self.thread = threading.Thread(target=self.run, name=f'generate-{name}', daemon=True)
+
+    def run(self):
+        try:
+            with self.run_lock:
+                if not self.cancelled:
+                    self.converter.convert()
+        except Exception as e: # pylint: disable=broad-except
+            print_error(f'Data converter failed: {e}')
+            self.error = e
+        finally:
+            with self.lock:
+                self.done.set()
+
+    # Also call `setup_progress` and `update_progress` with the progress of this job
+    def add_listener(self, setup_progress=None, update_progress=None):
+        self.listeners.append((setup_progress, update_progress))
+
+    def setup_progress(self, term):
+        self.term = term
+        self.progress = 0.0
+
+        for setup_progress, _ in self.listeners:
+            if setup_progress:
+                setup_progress(term)
+
+    def update_progress(self, value):
+        self.progress = value
+
+        for _, update_progress in self.listeners:
+            if update_progress:
+                update_progress(value)
+
+    def update_metrics(self, metrics):
+        self.metrics = metrics
+
+    # Stop the job, after it writes the rows read so far. Does nothing once the job is done,
+    # so that `cancelled` is only set when the conversion stopped early.
+    def cancel(self):
+        with self.lock:
+            if self.done.is_set():
+                return
+
+            self.cancelled = True
+            self.converter.cancel()
+
+    def running(self):
+        return not self.done.is_set()
+
+    # Returns whether the job is done
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+class JobRunner:
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.run_lock = threading.Lock()
+
+    # Start converting the terms of `settings`, or return the job which is already converting them
+    def submit(self, settings, config, setup_progress=None, update_progress=None):
+        with self.lock:
+            job = self.get(settings)
+
+            if job is None:
+                job = GenerationJob(settings, config, self.run_lock)
+                self.jobs[settings] = job
+                job.thread.start()
+
+            job.add_listener(setup_progress, update_progress)
+            return job
+
+    # The running job converting the terms of `settings`, if any
+    def get(self, settings):
+        job = self.jobs.get(settings)
+        return job if job and job.running() else None
+
+runner = JobRunner()
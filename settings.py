@@ -2,15 +2,39 @@
 #   Conversion from time-series data stored in git history
 #   to sqlite db files
 
-LIVE_DATA_ROOT = '../live-fhda-class-data/data/'
+import os
+
+# Can be overridden to convert another checkout (such as the benchmark fixture)
+LIVE_DATA_ROOT = os.environ.get('LIVE_DATA_ROOT', '../live-fhda-class-data/data/')
+
+# The data API (`cli serve`) used by the web app's playground
+API_URL = os.environ.get('API_URL', 'http://localhost:8000')
+
+# Times are stored as UTC epochs, and shown in the colleges' local time
+DISPLAY_TIMEZONE = 'America/Los_Angeles'
 
 class Config:
     interval_time = 10
     full_reset = True
+    workers = 1
+    batch_size = 50000
+    storage = 'dense'
+    decoder = 'auto'
+    profile = None
+    diff = True
+    sampling = 'grid'
 
-    def __init__(self, interval_time = 10, full_reset = True):
+    def __init__(self, interval_time = 10, full_reset = True, workers = 1, batch_size = 50000,
+                 storage = 'dense', decoder = 'auto', profile = None, diff = True, sampling = 'grid'):
         self.interval_time = interval_time
         self.full_reset = full_reset
+        self.workers = workers
+        self.batch_size = batch_size
+        self.storage = storage
+        self.decoder = decoder
+        self.profile = profile
+        self.diff = diff
+        self.sampling = sampling
 
 class Settings:
     start_sha = None
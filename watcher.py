@@ -0,0 +1,221 @@
+'''
+Keeps the term DBs up to date with the live data repo, as a long-running process
+
+Every `interval` seconds, the watcher fetches the data repo (without checking it out) and, when
+its branch moved, converts only the new snapshots of the watched terms. Its health and how far
+each term is behind the repo are written to `db/watch.json`, for the API's `/health` and the web app.
+
+Usage: `pipenv run cli watch [OPTIONS]`
+More Info: `pipenv run cli watch --help`
+'''
+
+import os
+import json
+import sqlite3
+import threading
+from time import time, perf_counter
+
+from generate_db import GitHistoryConverter, git_fetch, git_commit_time, print_info, print_error
+from settings import TERM_CODES_TO_CONFIG
+
+STATUS_PATH = 'db/watch.json'
+
+# The watcher is unhealthy when it missed this many fetches, its last updates failed,
+# or a term is more than `MAX_LAG` seconds of commits behind the data repo
+MISSED_FETCHES = 3
+MAX_FAILURES = 3
+MAX_LAG = 15 * 60
+
+# The settings of the terms which are still being scraped (without an end commit)
+def active_settings():
+    return unique_settings(settings for settings in TERM_CODES_TO_CONFIG.values() if not settings.end_sha)
+
+def unique_settings(settings):
+    return list(dict.fromkeys(settings))
+
+# The last snapshot converted into the DB of `term`, as (sha, epoch time), or (None, None)
+def read_term_watermark(term):
+    path = f'db/temp_{term}.sqlite3'
+    if not os.path.exists(path):
+        return None, None
+
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        row = conn.execute('SELECT value FROM meta WHERE key = "last_sha"').fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        conn.close()
+
+    sha = row and row[0]
+    return sha, sha and git_commit_time(sha)
+
+class Watcher:
+    settings = None
+    config = None
+    interval = 60
+    remote = 'origin'
+    branch = 'master'
+
+    def __init__(self, settings, config, interval=60, remote='origin', branch='master', status_path=STATUS_PATH):
+        self.settings = settings
+        self.config = config
+        self.interval = interval
+        self.remote = remote
+        self.branch = branch
+        self.status_path = status_path
+        # Converters (and their profilers) are kept between updates
+        self.converters = [GitHistoryConverter(s, config) for s in settings]
+        self.converter = None
+        self.stopped = threading.Event()
+        self.status = {
+            'pid': os.getpid(),
+            'started': int(time()),
+            'interval': interval,
+            'state': 'starting',
+            'updated': None,
+            'head': None,
+            'head_time': None,
+            'last_fetch': None,
+            'last_update': None,
+            'update_seconds': None,
+            'updates': 0,
+            'failures': 0,
+            'error': None,
+            'terms': {},
+        }
+
+    def run(self):
+        print_info(f'Watching {self.remote}/{self.branch} every {self.interval}s, use Ctrl+C to stop')
+
+        try:
+            while not self.stopped.is_set():
+                self.tick()
+                self.stopped.wait(self.interval)
+        finally:
+            self.set_state('stopped')
+
+    # Stop after the current update writes the rows read so far (can be called from any thread)
+    def stop(self):
+        self.stopped.set()
+
+        if self.converter:
+            self.converter.cancel()
+
+    # Fetch the repo, and convert its new snapshots if the branch moved
+    def tick(self):
+        self.set_state('fetching')
+        head = git_fetch(self.remote, self.branch)
+        self.status['last_fetch'] = int(time())
+
+        if head is None:
+            self.fail(f'Could not fetch {self.remote}/{self.branch}')
+            return
+
+        # Failed updates are retried even if the branch didn't move
+        if head == self.status['head'] and not self.status['failures']:
+            self.set_state('idle')
+            return
+
+        self.status['head'] = head
+        self.status['head_time'] = git_commit_time(head)
+        self.set_state('updating')
+        start = perf_counter()
+
+        try:
+            for converter in self.converters:
+                if self.stopped.is_set():
+                    break
+
+                self.converter = converter
+                converter.convert(head)
+        except Exception as e: # pylint: disable=broad-except
+            self.fail(f'Data converter failed: {e}')
+            return
+        finally:
+            self.converter = None
+
+        self.status.update({
+            'last_update': int(time()),
+            'update_seconds': round(perf_counter() - start, 3),
+            'updates': self.status['updates'] + 1,
+            'failures': 0,
+            'error': None,
+        })
+        self.set_state('idle')
+
+    def fail(self, error):
+        print_error(error)
+        self.status['failures'] += 1
+        self.status['error'] = error
+        self.set_state('error')
+
+    def set_state(self, state):
+        self.status['state'] = state
+        self.status['updated'] = int(time())
+        self.status['terms'] = self.term_lags()
+        write_status(self.status_path, self.status)
+
+    # How far each term is behind the head (or its end commit), in seconds of commit time
+    def term_lags(self):
+        lags = {}
+
+        for settings in self.settings:
+            head_time = (settings.end_sha and git_commit_time(settings.end_sha)) or self.status['head_time']
+
+            for term in settings.term_codes.values():
+                sha, epoch = read_term_watermark(term)
+                lags[term] = {
+                    'last_sha': sha,
+                    'last_time': epoch,
+                    'lag': max(head_time - epoch, 0) if head_time and epoch else None,
+                }
+
+        return lags
+
+# Replace the status file at once, so readers never see half of it
+def write_status(path, status):
+    tmp = f'{path}.tmp'
+
+    with open(tmp, 'w') as f:
+        json.dump(status, f, indent=2)
+
+    os.replace(tmp, path)
+
+def read_status(path=STATUS_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# The watcher's status with its health, or None if it never ran. It is healthy when it fetched
+# recently, its last updates didn't fail and the data isn't behind the fetched head.
+def health(status, now=None):
+    if status is None:
+        return None
+
+    now = now or time()
+    fetched = status.get('last_fetch') or status.get('started') or 0
+    problems = []
+
+    if status.get('state') == 'stopped':
+        problems.append('the watcher is stopped')
+    elif now - fetched > status.get('interval', 60) * MISSED_FETCHES:
+        problems.append(f'no fetch for {int(now - fetched)}s')
+
+    if status.get('failures', 0) >= MAX_FAILURES:
+        problems.append(f'{status["failures"]} failed updates: {status.get("error")}')
+
+    behind = [term for term, lag in status.get('terms', {}).items() if lag.get('lag') is None or lag['lag'] > MAX_LAG]
+    if behind and status.get('head_time') and status.get('state') != 'updating':
+        problems.append(f'behind the data repo: {", ".join(behind)}')
+
+    head_time = status.get('head_time')
+    return {
+        **status,
+        'healthy': not problems,
+        'problems': problems,
+        # How old the newest snapshot of the data repo is
+        'head_age': int(now - head_time) if head_time else None,
+    }